@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+"""
+asyncio front end for server.py (Python 3.7+).
+
+Requests are routed exactly as in server.py, through
+`response()` and its `op` table, but a slow command no
+longer holds up everyone else.  Commands that touch the
+simulation run one at a time on a dedicated executor
+thread; parameter and status commands (see IMMEDIATE)
+only read or set a few attributes and are answered
+straight from the event loop, even while a step is in
+progress, unless they are the first request of a new
+session.  Commands that set a parameter (see MUTATING)
+wait their turn on the executor instead whenever work is
+queued or running there, so they never land in the middle
+of a batch.
+
+Connections are HTTP/1.1 and stay open between requests
+unless the client asks otherwise; replies carry a
+Content-Length, or are chunked when compressed.
+
+A WebSocket connection to /stream pushes frames instead
+of waiting to be polled:
+
+   ws://localhost:8001/stream?fps=30&iterations=1&format=f32&session=TOKEN
+
+Each frame advances the session by `iterations` and sends
+the field as a binary message: float32 values (format=f32,
+as for `step`) or a PNG image (format=png); other formats
+are refused with 400.  At most `window` frames (default 2)
+are sent ahead of the client, which must send a text or
+binary message (anything, e.g. "ack") for every frame it
+has handled.  A text message "fps=N" changes the rate
+instead.
+
+Usage::
+    python3 aioserver.py 8001
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+import encoding
+from framecache import FrameGone
+import ingest
+import server
+import websocket
+
+
+# Commands answered without waiting for the simulation.
+IMMEDIATE = set(['beta', 'iterations', 'n', 'residuals', 'status'])
+
+# Of these, the ones that change a session.
+MUTATING = set(['beta', 'iterations', 'n'])
+
+# Frame formats of /stream.
+STREAM_FORMATS = set(['f32', 'png'])
+
+# All simulation work goes through this single thread, so
+# commands that touch the state never overlap.
+compute = ThreadPoolExecutor(max_workers=1)
+
+# Number of jobs submitted to `compute` and not yet done.
+jobs = { 'pending': 0 }
+
+
+async def on_compute(fn, *args):
+    """await fn(*args) on the compute thread."""
+    jobs['pending'] = jobs['pending'] + 1
+    try:
+        return await asyncio.get_event_loop().run_in_executor(compute, fn, *args)
+    finally:
+        jobs['pending'] = jobs['pending'] - 1
+
+
+class AsyncCoalescer(object):
+    """coalesce.Coalescer for coroutines on the event loop."""
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+
+    async def run(self, key, fn):
+        """await fn(), or the result of a concurrent call with the same key."""
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._lead(key, fn))
+            self.pending[key] = future
+        # One waiter going away must not cancel the others.
+        return await asyncio.shield(future)
+
+    async def _lead(self, key, fn):
+        try:
+            await asyncio.sleep(self.window)
+            return await fn()
+        finally:
+            del self.pending[key]
+
+
+coalescer = AsyncCoalescer(server.coalescer.window)
+
+
+async def read_request(reader):
+    """Return (method, path, version, headers), or None at end of stream."""
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+    if len(parts) < 2:
+        return None
+    version = parts[2] if len(parts) > 2 else 'HTTP/1.0'
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        (name, _sep, value) = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return (parts[0], parts[1], version, headers)
+
+
+def keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+def head(status=200, ctype='text/html', length=0, content_encoding=None, keep=True,
+         allow=None):
+    """
+    Response headers; a compressed body is sent chunked.
+    With `length` None there is no Content-Length (HEAD).
+    """
+    if content_encoding:
+        extra = ("Content-Encoding: " + content_encoding + "\r\n"
+                 "Transfer-Encoding: chunked\r\n")
+    elif length is not None:
+        extra = "Content-Length: " + str(length) + "\r\n"
+    else:
+        extra = ""
+    if not keep:
+        extra = extra + "Connection: close\r\n"
+    if allow:
+        extra = extra + "Allow: " + allow + "\r\n"
+    return ("HTTP/1.1 " + str(status) + " " + HTTPStatus(status).phrase + "\r\n"
+            "Content-type: " + ctype + "\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            "Vary: Accept-Encoding\r\n" + extra +
+            "\r\n").encode('latin-1')
+
+
+async def write_compressed(writer, body, coding):
+    # Each piece is compressed on a worker thread, off both
+    # the event loop and the compute thread.
+    loop = asyncio.get_event_loop()
+    pieces = encoding.chunks(body, coding)
+    while True:
+        piece = await loop.run_in_executor(None, next, pieces, None)
+        if piece is None:
+            break
+        writer.write(encoding.chunk(piece))
+        await writer.drain()
+    writer.write(encoding.LAST_CHUNK)
+
+
+async def receive_upload(reader, path, length):
+    # The body is parsed and copied to a memmap on a worker
+    # thread, which pulls it from the connection piece by
+    # piece; only loading it runs on the compute thread.
+    # Raises ValueError if the body is rejected.
+    loop = asyncio.get_event_loop()
+
+    def read(n):
+        return asyncio.run_coroutine_threadsafe(reader.read(n), loop).result()
+
+    return await loop.run_in_executor(None, ingest.read_field, read, length,
+                                      *ingest.parse_args(server.parse(path)['arg']))
+
+
+async def run_command(path):
+    c = server.parse(path)
+    cmd = c['cmd']
+    if cmd in IMMEDIATE and not (cmd in MUTATING and jobs['pending']):
+        # Only for sessions that exist already: creating and
+        # evicting them is work for the compute thread.
+        body = server.sessions.peek(c['session'], lambda d: server.dispatch(d, c))
+        if body is not None:
+            return body
+    run = lambda: on_compute(server.response, path)
+    if cmd in server.COALESCED:
+        return await coalescer.run(path, run)
+    return await run()
+
+
+def next_frame(token, iterations, fmt):
+    d = server.sessions.get(token)
+    if fmt == 'png':
+        # Rendered straight from the state; the field itself
+        # is never read back.
+        d.iterations = iterations
+        d.step()
+        body = d.png_bytes()
+    else:
+        body = server.step(d, str(iterations))
+    server.sessions.enforce(token)
+    return body
+
+
+async def stream(reader, writer, path, headers):
+    params = parse_qs(path.partition('?')[2])
+    token = params.get('session', [''])[0]
+    fmt = params.get('format', ['f32'])[0]
+    try:
+        if fmt not in STREAM_FORMATS:
+            raise ValueError("unknown stream format: " + fmt)
+        iterations = int(params.get('iterations', ['1'])[0])
+        rate = { 'fps': float(params.get('fps', ['30'])[0]) }
+        window = asyncio.Semaphore(int(params.get('window', ['2'])[0]))
+    except ValueError as e:
+        body = str(e).encode('utf-8')
+        writer.write(head(400, 'text/plain', len(body), None, False))
+        writer.write(body)
+        await writer.drain()
+        return
+    closed = asyncio.Event()
+    writer.write(websocket.handshake(headers))
+
+    async def listen():
+        # Acknowledgements, rate changes and control frames.
+        try:
+            while True:
+                (opcode, payload) = await websocket.read_frame(reader)
+                if opcode == websocket.CLOSE:
+                    writer.write(websocket.frame(websocket.CLOSE, payload[:2]))
+                    break
+                elif opcode == websocket.PING:
+                    writer.write(websocket.frame(websocket.PONG, payload))
+                elif opcode == websocket.TEXT and payload.startswith(b'fps='):
+                    rate['fps'] = float(payload[4:])
+                elif opcode in (websocket.TEXT, websocket.BINARY):
+                    window.release()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        closed.set()
+        window.release()
+
+    listener = asyncio.ensure_future(listen())
+    count = 0
+    try:
+        while not closed.is_set():
+            start = time.time()
+            await window.acquire()
+            if closed.is_set():
+                break
+            # Viewers streaming the same session in step share frames.
+            body = await coalescer.run(('stream', token, iterations, fmt),
+                                       lambda: on_compute(next_frame, token, iterations, fmt))
+            writer.write(websocket.frame(websocket.BINARY, body))
+            await writer.drain()
+            count = count + 1
+            delay = 1.0 / max(rate['fps'], 0.001) - (time.time() - start)
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(closed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+    except ConnectionError:
+        pass
+    finally:
+        listener.cancel()
+    print("stream closed after " + str(count) + " frames")
+
+
+async def handle(reader, writer):
+    # Requests on one connection, including pipelined ones,
+    # are answered in order until the client closes it.
+    try:
+        while True:
+            request = await read_request(reader)
+            if request is None:
+                return
+            start = time.time()
+            (method, path, version, headers) = request
+            if websocket.is_upgrade(headers) and server.parse(path)['cmd'] == 'stream':
+                await stream(reader, writer, path, headers)
+                return
+            keep = keep_alive(version, headers)
+            length = int(headers.get('content-length', 0))
+            if method == 'POST' and server.parse(path)['cmd'] == 'upload':
+                try:
+                    array = await receive_upload(reader, path, length)
+                except ValueError as e:
+                    # The rest of the body is unread.
+                    print("upload failed: " + str(e))
+                    body = str(e).encode('utf-8')
+                    writer.write(head(400, 'text/plain', len(body), None, False))
+                    writer.write(body)
+                    await writer.drain()
+                    return
+                try:
+                    body = await on_compute(server.upload, path, array)
+                    status = 200
+                except ValueError as e:
+                    # The backend can't hold it, e.g. too small
+                    # for the cluster grid.
+                    (body, status) = (str(e), 400)
+                body = body.encode('utf-8')
+                ctype = 'application/json' if status == 200 else 'text/plain'
+                writer.write(head(status, ctype, len(body), None, keep))
+                writer.write(body)
+                await writer.drain()
+                if not keep:
+                    return
+                continue
+            posted = await reader.readexactly(length) if length else b''
+            if method == 'GET':
+                try:
+                    body = await run_command(path)
+                except (FrameGone, ValueError, TypeError) as e:
+                    # 400 for a malformed argument, e.g. step=abc
+                    # or data=roi:1:2.
+                    body = str(e).encode('utf-8')
+                    status = 404 if isinstance(e, FrameGone) else 400
+                    writer.write(head(status, 'text/plain', len(body), None, keep))
+                    writer.write(body)
+                    await writer.drain()
+                    if not keep:
+                        return
+                    continue
+                coding = server.content_encoding(path, headers.get('accept-encoding'), body)
+                if coding and version == 'HTTP/1.0':
+                    coding = None
+                writer.write(head(200, server.content_type(path), len(body), coding, keep))
+                if coding:
+                    await write_compressed(writer, body, coding)
+                else:
+                    writer.write(body)
+            elif method == 'HEAD':
+                # Headers only, as server.py's do_HEAD.
+                writer.write(head(200, server.content_type(path), None, None, keep))
+            elif method != 'POST':
+                body = b"method not allowed"
+                writer.write(head(405, 'text/plain', len(body), None, keep, 'GET, HEAD, POST'))
+                writer.write(body)
+            elif server.parse(path)['cmd'] == 'batch':
+                # The whole batch is one job for the compute thread.
+                try:
+                    body = await on_compute(server.batch, path, posted)
+                except ValueError as e:
+                    body = str(e).encode('utf-8')
+                    writer.write(head(400, 'text/plain', len(body), None, keep))
+                    writer.write(body)
+                    await writer.drain()
+                    if not keep:
+                        return
+                    continue
+                coding = encoding.negotiate(headers.get('accept-encoding'), len(body))
+                if coding and version == 'HTTP/1.0':
+                    coding = None
+                writer.write(head(200, 'application/octet-stream', len(body), coding, keep))
+                if coding:
+                    await write_compressed(writer, body, coding)
+                else:
+                    writer.write(body)
+            else:
+                body = b"<html><body><h1>POST!</h1></body></html>"
+                writer.write(head(200, 'text/html', len(body), None, keep))
+                writer.write(body)
+            await writer.drain()
+            end = time.time()
+            print(1000*(end - start))
+            if not keep:
+                return
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port):
+    httpd = await asyncio.start_server(handle, '', port)
+    print('Starting asyncio httpd on port ' + str(port))
+    async with httpd:
+        await httpd.serve_forever()
+
+
+def run(port=8001):
+    asyncio.run(serve(port))
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    if len(argv) == 2:
+        run(port=int(argv[1]))
+    else:
+        run()
@@ -0,0 +1,750 @@
+"""
+Compute backends for the heat server.
+
+A backend knows how to move a temperature field onto
+whatever device it computes on, how to advance it by
+some number of `newField` iterations (see heat.fut),
+and how to bring it back as a numpy array.  Every
+backend implements the same small interface:
+
+   upload(array)                 -> state
+   download(state)               -> 2D numpy float32 array
+   step(state, iterations, beta) -> state
+   render(state)                 -> [rows][cols][3] uint8 array
+   stats(state)                  -> (min, max, mean)
+   step_delta(state, beta)       -> (state, max|change|)
+   quantize(state, bits)         -> (min, max, uint8/uint16 array)
+   mipmap(state, levels)         -> pyramid
+   lod(pyramid, level, window)   -> 2D numpy float32 array
+   crop(state, window)           -> 2D numpy float32 array
+   paste(state, window, array)   -> state
+
+A pyramid holds block-averaged copies of the field, each
+half the size of the one before (rounded up; see
+`downsample`), and is kept wherever the backend computes.
+Level 1 is the first half-size copy.
+
+A `window` is (r0, r1, c0, c1), rows r0 to r1 - 1 and
+columns c0 to c1 - 1, within bounds; only that rectangle
+is read back.  For `lod` it may be None, meaning the whole
+level.  `paste` writes `array` into the window in place
+(cluster workers use it for their halos; the cluster
+backend itself does not implement it).
+
+Backends meant for fields too large to gather onto the
+server's host and process there in one piece (shm,
+cluster) have `host_sized = False`; the server then
+iterates instead of using its whole-field host algorithms
+(spectral.py, multigrid.py).
+
+`state` is opaque to the caller: a `cl.array.Array`
+for the Futhark backend, a `Field` for the numpy one,
+a `SharedField` for the shared-memory one and a
+`cluster.ClusterField` for the multi-node one.
+
+An ensemble of independent fields of the same size is
+uploaded as a single [batch][rows][cols] array and
+advanced with
+
+   step_ensemble(state, iterations, betas) -> state
+
+where `betas` has one entry per member.  Each iteration
+updates the whole batch at once.
+
+Use `make_backend(name)` to get one.  With no name the
+Futhark/OpenCL backend is tried first and the numpy
+backend is used if OpenCL is not available.
+"""
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+import numpy as np
+
+
+# Rows are processed in tiles of about this many bytes per
+# array so that src, dst and scratch stay in a core's L2.
+L2_BYTES = 256 * 1024
+
+
+#### NUMPY BACKEND ####
+
+def _update(src, dst, scratch, beta, r0, r1):
+    # One application of newField to interior rows r0..r1-1
+    # of `src`, written to the same rows of `dst`.  Edges are
+    # not touched.  Everything is done with out= arguments so
+    # that no temporaries are allocated.  `beta` is a pair
+    # (beta/4, 1-beta) of float32 scalars (or arrays that
+    # broadcast against the field).
+    (w_avg, w_self) = beta
+    s = src[..., r0-1:r1+1, :]
+    out = dst[..., r0:r1, 1:-1]
+    tmp = scratch[..., r0:r1, 1:-1]
+    np.add(s[..., :-2, 1:-1], s[..., 2:, 1:-1], out=out)
+    np.add(out, s[..., 1:-1, :-2], out=out)
+    np.add(out, s[..., 1:-1, 2:], out=out)
+    np.multiply(out, w_avg, out=out)
+    np.multiply(s[..., 1:-1, 1:-1], w_self, out=tmp)
+    np.add(out, tmp, out=out)
+
+
+def _bands(first, last, parts):
+    # Split rows first..last-1 into `parts` contiguous bands.
+    parts = max(1, min(parts, last - first))
+    size = (last - first + parts - 1) // parts
+    return [(r, min(r + size, last)) for r in range(first, last, size)]
+
+
+def png_red(array):
+    # pngRed: red channel = u8.f32(255*x)
+    image = np.zeros(array.shape + (3,), dtype=np.uint8)
+    image[..., 0] = (255 * array).astype(np.uint8)
+    return image
+
+
+def field_stats(array):
+    return (float(array.min()), float(array.max()), float(array.mean()))
+
+
+def _scale(lo, hi, bits):
+    return 0.0 if hi <= lo else ((1 << bits) - 1) / (hi - lo)
+
+
+def quantize_array(array, bits):
+    # round((x - min) / (max - min) * (2^bits - 1)); an empty
+    # window has lo = hi = 0.
+    if array.size == 0:
+        return (0.0, 0.0, np.zeros(array.shape, np.uint8 if bits == 8 else np.uint16))
+    lo = float(array.min())
+    hi = float(array.max())
+    q = (array - np.float32(lo)) * np.float32(_scale(lo, hi, bits))
+    np.rint(q, out=q)
+    return (lo, hi, q.astype(np.uint8 if bits == 8 else np.uint16))
+
+
+def downsample(array):
+    """The 2x2 block averages of `array`, ceil(rows/2) x ceil(cols/2).
+
+    An odd last row or column is averaged with itself.
+    """
+    (rows, cols) = array.shape
+    if rows % 2:
+        array = np.vstack([array, array[-1:]])
+    if cols % 2:
+        array = np.hstack([array, array[:, -1:]])
+    return np.float32(0.25) * (array[0::2, 0::2] + array[1::2, 0::2]
+                               + array[0::2, 1::2] + array[1::2, 1::2])
+
+
+def crop_array(array, window):
+    if window is None:
+        return array
+    (r0, r1, c0, c1) = window
+    return array[r0:r1, c0:c1].copy()
+
+
+def mipmap_array(array, levels):
+    pyramid = []
+    for _k in range(levels):
+        array = downsample(array)
+        pyramid.append(array)
+    return pyramid
+
+
+def _weights(beta):
+    beta = np.asarray(beta, dtype=np.float32)
+    return (beta * np.float32(0.25), np.float32(1) - beta)
+
+
+class Field(object):
+    """
+    A host-side temperature field.  `front` holds the current
+    values; `back` and `scratch` are preallocated buffers of the
+    same shape used by `NumpyBackend.step`, which swaps front
+    and back after each iteration instead of allocating.
+    """
+
+    def __init__(self, array):
+        self.front = np.array(array, dtype=np.float32, order='C')
+        # The edges never change, so copying them once into
+        # the back buffer is enough.
+        self.back = self.front.copy()
+        self.scratch = np.empty_like(self.front)
+
+    @property
+    def shape(self):
+        return self.front.shape
+
+    @property
+    def nbytes(self):
+        return 3 * self.front.nbytes
+
+    def swap(self):
+        (self.front, self.back) = (self.back, self.front)
+
+
+class NumpyBackend(object):
+    """
+    Vectorized numpy implementation of heat.fut.  The interior
+    is split into one band of rows per thread, and each band is
+    updated a few L2-sized tiles of rows at a time.  numpy
+    releases the GIL inside the ufuncs, so the bands run in
+    parallel.
+
+    With time_block=k > 1, iterations are done k at a time: each
+    tile is copied together with a halo of k rows on either side
+    into a small cache-resident buffer, advanced k times there,
+    and only its centre is written back.  This reads and writes
+    the whole field once per k iterations instead of once per
+    iteration, at the price of recomputing the halos.
+    """
+
+    name = 'numpy'
+    host_sized = True
+
+    def __init__(self, threads=None, time_block=1, **options):
+        self.threads = threads or multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.threads) if self.threads > 1 else None
+        self.time_block = max(1, time_block)
+        self.tiles = {}
+
+    def _run_bands(self, band, rows):
+        bands = _bands(1, rows - 1, self.threads)
+        if self.pool is None or len(bands) == 1:
+            for b in bands:
+                band(b)
+        else:
+            self.pool.map(band, bands)
+
+    def _sweep(self, field, weights):
+        # One iteration from field.front into field.back.
+        rows = field.shape[-2]
+        row_bytes = field.front.nbytes // rows
+        tile = max(1, L2_BYTES // row_bytes)
+        (src, dst, scratch) = (field.front, field.back, field.scratch)
+
+        def band(bounds):
+            (r0, r1) = bounds
+            for r in range(r0, r1, tile):
+                _update(src, dst, scratch, weights, r, min(r + tile, r1))
+
+        self._run_bands(band, rows)
+
+    def _tile_buffers(self, shape):
+        # Three tile-sized buffers per thread, kept between calls.
+        if shape not in self.tiles:
+            self.tiles = { shape: {} }
+        buffers = self.tiles[shape]
+        thread = threading.current_thread().ident
+        if thread not in buffers:
+            buffers[thread] = tuple(np.empty(shape, dtype=np.float32) for _i in range(3))
+        return buffers[thread]
+
+    def _blocked_sweep(self, field, weights, k):
+        # k iterations from field.front into field.back.
+        shape = field.shape
+        rows = shape[-2]
+        row_bytes = field.front.nbytes // rows
+        tile = max(2 * k, L2_BYTES // (3 * row_bytes) - 2 * k)
+        tile_shape = shape[:-2] + (tile + 2 * k, shape[-1])
+        (src, dst) = (field.front, field.back)
+
+        def band(bounds):
+            (r0, r1) = bounds
+            (a, b, scratch) = self._tile_buffers(tile_shape)
+            for t0 in range(r0, r1, tile):
+                t1 = min(t0 + tile, r1)
+                # Rows lo..hi-1 with the halo, clipped to the field.
+                # The first and last of them stay fixed: they are
+                # either edges of the field or halo rows, whose
+                # error moves one row inward per iteration and so
+                # never reaches t0..t1-1.
+                lo = max(0, t0 - k)
+                hi = min(rows, t1 + k)
+                h = hi - lo
+                (x, y) = (a[..., :h, :], b[..., :h, :])
+                np.copyto(x, src[..., lo:hi, :])
+                np.copyto(y, x)
+                for _i in range(k):
+                    _update(x, y, scratch, weights, 1, h - 1)
+                    (x, y) = (y, x)
+                np.copyto(dst[..., t0:t1, :], x[..., t0-lo:t1-lo, :])
+
+        self._run_bands(band, rows)
+
+    def upload(self, array):
+        return Field(array)
+
+    def download(self, field):
+        return field.front.copy()
+
+    def step(self, field, iterations, beta):
+        rows = field.shape[-2]
+        if rows < 3 or field.shape[-1] < 3:
+            return field
+        weights = _weights(beta)
+        k = self.time_block
+        done = 0
+        if k > 1:
+            while iterations - done >= k:
+                self._blocked_sweep(field, weights, k)
+                field.swap()
+                done = done + k
+        for _i in range(iterations - done):
+            self._sweep(field, weights)
+            field.swap()
+        return field
+
+    def step_ensemble(self, field, iterations, betas):
+        betas = np.asarray(betas, dtype=np.float32).reshape(-1, 1, 1)
+        return self.step(field, iterations, betas)
+
+    def step_delta(self, field, beta):
+        rows = field.shape[-2]
+        if rows < 3 or field.shape[-1] < 3:
+            return (field, 0.0)
+        self._sweep(field, _weights(beta))
+        diff = field.scratch
+        np.subtract(field.back, field.front, out=diff)
+        np.abs(diff, out=diff)
+        field.swap()
+        return (field, float(diff.max()))
+
+    def render(self, field):
+        return png_red(field.front)
+
+    def stats(self, field):
+        return field_stats(field.front)
+
+    def quantize(self, field, bits):
+        return quantize_array(field.front, bits)
+
+    def mipmap(self, field, levels):
+        return mipmap_array(field.front, levels)
+
+    def lod(self, pyramid, level, window=None):
+        return crop_array(pyramid[level - 1], window)
+
+    def crop(self, field, window):
+        return crop_array(field.front, window)
+
+    def paste(self, field, window, array):
+        # Into both buffers: step() relies on their edges
+        # being equal.
+        (r0, r1, c0, c1) = window
+        field.front[r0:r1, c0:c1] = array
+        field.back[r0:r1, c0:c1] = array
+        return field
+
+
+#### SHARED MEMORY BACKEND ####
+
+def _attach(names, shape, r0, r1):
+    from multiprocessing import shared_memory
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    buffers = [np.ndarray(shape, dtype=np.float32, buffer=b.buf) for b in blocks]
+    scratch = np.empty(buffers[0][..., r0-1:r1+1, :].shape, dtype=np.float32)
+    return (blocks, buffers, scratch)
+
+
+def _strip_run(buffers, scratch, r0, r1, barrier, iterations, beta, parity, want_delta):
+    # Interior rows r0..r1-1 of both buffers belong to this
+    # worker.  The rows on either side belong to the
+    # neighbouring strips; the barrier after each iteration
+    # guarantees they are up to date before they are read as
+    # halos.
+    weights = _weights(beta)
+    for i in range(iterations):
+        src = buffers[(parity + i) % 2][..., r0-1:r1+1, :]
+        dst = buffers[(parity + i + 1) % 2][..., r0-1:r1+1, :]
+        _update(src, dst, scratch, weights, 1, r1 - r0 + 1)
+        barrier.wait()
+    change = 0.0
+    if want_delta and iterations > 0:
+        np.subtract(dst, src, out=scratch)
+        np.abs(scratch, out=scratch)
+        change = float(scratch[..., 1:-1, :].max())
+    return change
+
+
+def _strip_worker(barrier, conn):
+    # One process of a StripPool.  A field's blocks are
+    # attached by name the first time it is stepped and kept
+    # until it is freed.  A worker without rows in a field
+    # only keeps the others company at the barrier.
+    fields = {}
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        if msg[0] == 'free':
+            entry = fields.pop(msg[1], None)
+            if entry is not None:
+                blocks = entry[0]
+                del entry
+                for b in blocks:
+                    b.close()
+            continue
+        (_op, names, shape, r0, r1, iterations, beta, parity, want_delta) = msg
+        if r0 == r1:
+            for _i in range(iterations):
+                barrier.wait()
+            conn.send(0.0)
+            continue
+        if names[0] not in fields:
+            fields[names[0]] = _attach(names, shape, r0, r1)
+        (_blocks, buffers, scratch) = fields[names[0]]
+        conn.send(_strip_run(buffers, scratch, r0, r1, barrier,
+                             iterations, beta, parity, want_delta))
+        del buffers, scratch
+    conn.close()
+
+
+class StripPool(object):
+    """
+    The worker processes of a SharedMemoryBackend, forked once
+    and shared by all its fields.  Each step hands every
+    worker the names of the field's shared memory blocks and
+    its strip of rows.
+    """
+
+    def __init__(self, processes):
+        from multiprocessing import resource_tracker
+        # Started before the fork, so that the blocks the
+        # workers attach to are tracked once, by the process
+        # that unlinks them.
+        resource_tracker.ensure_running()
+        ctx = multiprocessing.get_context('fork')
+        self.size = processes
+        self.barrier = ctx.Barrier(processes)
+        self.lock = threading.RLock()
+        self.conns = []
+        self.procs = []
+        for _i in range(processes):
+            (conn, child) = ctx.Pipe()
+            p = ctx.Process(target=_strip_worker, args=(self.barrier, child))
+            p.daemon = True
+            p.start()
+            child.close()
+            self.conns.append(conn)
+            self.procs.append(p)
+
+    def run(self, field, iterations, beta, want_delta):
+        with self.lock:
+            for (conn, (r0, r1)) in zip(self.conns, field.bands):
+                conn.send(('step', field.names, field.shape, r0, r1,
+                           iterations, beta, field.parity, want_delta))
+            return max(conn.recv() for conn in self.conns)
+
+    def free(self, field):
+        with self.lock:
+            for conn in self.conns:
+                conn.send(('free', field.names[0]))
+
+
+class SharedField(object):
+    """
+    A field held in two multiprocessing.shared_memory blocks
+    (front and back), stepped by the processes of a StripPool,
+    one strip of rows each.  Nothing is copied between
+    processes: each worker updates its strip in place and
+    reads its neighbours' edge rows straight from shared
+    memory.
+    """
+
+    def __init__(self, array, strips):
+        from multiprocessing import shared_memory
+        array = np.asarray(array, dtype=np.float32)
+        self.blocks = [shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+                       for _i in range(2)]
+        self.names = [b.name for b in self.blocks]
+        self.buffers = [np.ndarray(array.shape, dtype=np.float32, buffer=b.buf)
+                        for b in self.blocks]
+        for b in self.buffers:
+            b[...] = array
+        self.parity = 0
+        self.strips = strips
+        rows = array.shape[-2]
+        if rows < 3 or array.shape[-1] < 3:
+            self.bands = []
+        else:
+            bands = _bands(1, rows - 1, strips.size)
+            self.bands = bands + [(1, 1)] * (strips.size - len(bands))
+
+    @property
+    def front(self):
+        return self.buffers[self.parity]
+
+    @property
+    def back(self):
+        return self.buffers[1 - self.parity]
+
+    @property
+    def shape(self):
+        return self.front.shape
+
+    @property
+    def nbytes(self):
+        return 2 * self.front.nbytes
+
+    def run(self, iterations, beta, want_delta=False):
+        change = 0.0
+        if self.bands:
+            change = self.strips.run(self, iterations, beta, want_delta)
+        self.parity = (self.parity + iterations) % 2
+        return change
+
+    def close(self):
+        if self.blocks is None:
+            return
+        if self.bands:
+            self.strips.free(self)
+        self.buffers = None
+        for b in self.blocks:
+            b.close()
+            b.unlink()
+        self.blocks = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class SharedMemoryBackend(NumpyBackend):
+    """
+    Domain decomposition over worker processes on one host, for
+    fields too large for one core (Python 3.8+, Linux).  Reading
+    back, rendering and stats are done by the numpy backend on
+    the shared front buffer.
+    """
+
+    name = 'shm'
+    host_sized = False
+
+    def __init__(self, processes=None, **options):
+        NumpyBackend.__init__(self, threads=1)
+        self.processes = processes or multiprocessing.cpu_count()
+        # Not `pool`: that is NumpyBackend's thread pool.
+        self.strips = StripPool(self.processes)
+
+    def upload(self, array):
+        return SharedField(array, self.strips)
+
+    def step(self, field, iterations, beta):
+        field.run(iterations, beta)
+        return field
+
+    def step_delta(self, field, beta):
+        return (field, field.run(1, beta, want_delta=True))
+
+
+#### FUTHARK BACKEND ####
+
+# newField over a [batch][rows][cols] array with one beta per
+# member, one work item per cell.  Used for ensembles, which
+# heat.fut has no entry point for.
+ensemble_src = """
+__kernel void ensemble_step(int rows, int cols,
+                            __global const float *beta,
+                            __global const float *src,
+                            __global float *dst)
+{
+    const int gid = get_global_id(0);
+    const int plane = rows * cols;
+    const int b = gid / plane;
+    const int r = (gid % plane) / cols;
+    const int c = gid % cols;
+    float x = src[gid];
+    if (r > 0 && r < rows-1 && c > 0 && c < cols-1) {
+        const float sum = src[gid-cols] + src[gid+cols] + src[gid-1] + src[gid+1];
+        x = (1-beta[b]) * x + beta[b] * (sum / 4.0f);
+    }
+    dst[gid] = x;
+}
+"""
+
+# One level of the pyramid from the one below, one work
+# item per output cell; matches `downsample`.
+mipmap_src = """
+__kernel void downsample(int rows, int cols,
+                         __global const float *src,
+                         __global float *dst)
+{
+    const int gid = get_global_id(0);
+    const int half_cols = (cols + 1) / 2;
+    const int r0 = 2 * (gid / half_cols);
+    const int c0 = 2 * (gid % half_cols);
+    const int r1 = min(r0 + 1, rows - 1);
+    const int c1 = min(c0 + 1, cols - 1);
+    dst[gid] = 0.25f * (src[r0*cols + c0] + src[r1*cols + c0]
+                        + src[r0*cols + c1] + src[r1*cols + c1]);
+}
+"""
+
+class FutharkBackend(object):
+    """
+    The compiled Futhark kernel.  Run
+
+       $ futhark pyopencl --library heat.fut
+
+    to produce heat.py.
+    """
+
+    name = 'futhark'
+    host_sized = True
+
+    def __init__(self, **options):
+        import pyopencl
+        import pyopencl.array
+        from pyopencl.reduction import ReductionKernel
+        from pyopencl.elementwise import ElementwiseKernel
+        import heat # import heat.py
+        self.cl = pyopencl
+        self.cl_array = pyopencl.array
+        self.kernel = heat.heat()
+        self.queue = self.kernel.queue
+        self.max_abs_diff = ReductionKernel(self.kernel.ctx, np.float32,
+                                            neutral="0",
+                                            reduce_expr="fmax(a, b)",
+                                            map_expr="fabs(x[i] - y[i])",
+                                            arguments="__global const float *x, "
+                                                      "__global const float *y")
+        self.ensemble_program = pyopencl.Program(self.kernel.ctx, ensemble_src).build()
+        self.mipmap_program = pyopencl.Program(self.kernel.ctx, mipmap_src).build()
+        self.min_max = ReductionKernel(self.kernel.ctx, pyopencl.array.vec.float2,
+                                       neutral="(float2)(INFINITY, -INFINITY)",
+                                       reduce_expr="(float2)(fmin(a.x, b.x), fmax(a.y, b.y))",
+                                       map_expr="(float2)(x[i], x[i])",
+                                       arguments="__global const float *x")
+        self.quantizers = {}
+        for (bits, ctype) in ((8, 'uchar'), (16, 'ushort')):
+            self.quantizers[bits] = ElementwiseKernel(
+                self.kernel.ctx,
+                "__global const float *x, __global " + ctype + " *q, float lo, float scale",
+                "q[i] = convert_" + ctype + "_sat_rte((x[i] - lo) * scale)")
+
+    def upload(self, array):
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        return self.cl_array.to_device(self.queue, array)
+
+    def download(self, state):
+        return state.get()
+
+    def step(self, state, iterations, beta):
+        return self.kernel.step(iterations, beta, state)
+
+    def step_ensemble(self, state, iterations, betas):
+        (batch, rows, cols) = state.shape
+        betas = np.asarray(betas, dtype=np.float32).reshape(batch)
+        betas = self.cl_array.to_device(self.queue, betas)
+        kernel = self.ensemble_program.ensemble_step
+        other = self.cl_array.empty_like(state)
+        for _i in range(iterations):
+            kernel(self.queue, (batch * rows * cols,), None,
+                   np.int32(rows), np.int32(cols),
+                   betas.data, state.data, other.data)
+            (state, other) = (other, state)
+        return state
+
+    def step_delta(self, state, beta):
+        new = self.kernel.step(1, beta, state)
+        return (new, float(self.max_abs_diff(new, state).get()))
+
+    def render(self, state):
+        return self.kernel.render(state).get()
+
+    def mipmap(self, state, levels):
+        kernel = self.mipmap_program.downsample
+        pyramid = []
+        for _k in range(levels):
+            (rows, cols) = state.shape
+            half = self.cl_array.empty(self.queue, ((rows + 1) // 2, (cols + 1) // 2),
+                                       np.float32)
+            kernel(self.queue, (half.size,), None,
+                   np.int32(rows), np.int32(cols), state.data, half.data)
+            pyramid.append(half)
+            state = half
+        return pyramid
+
+    def lod(self, pyramid, level, window=None):
+        if window is None:
+            return pyramid[level - 1].get()
+        return self.crop(pyramid[level - 1], window)
+
+    def crop(self, state, window):
+        # A rectangular copy: only the rows and columns of
+        # the window cross the bus.
+        (r0, r1, c0, c1) = window
+        cols = state.shape[1]
+        out = np.empty((r1 - r0, c1 - c0), dtype=np.float32)
+        if out.size:
+            self.cl.enqueue_copy(self.queue, out, state.base_data,
+                                 buffer_origin=(4 * c0 + state.offset, r0),
+                                 host_origin=(0, 0),
+                                 region=(4 * (c1 - c0), r1 - r0),
+                                 buffer_pitches=(4 * cols,),
+                                 host_pitches=(4 * (c1 - c0),))
+        return out
+
+    def paste(self, state, window, array):
+        (r0, r1, c0, c1) = window
+        cols = state.shape[1]
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        if array.size:
+            self.cl.enqueue_copy(self.queue, state.base_data, array,
+                                 buffer_origin=(4 * c0 + state.offset, r0),
+                                 host_origin=(0, 0),
+                                 region=(4 * (c1 - c0), r1 - r0),
+                                 buffer_pitches=(4 * cols,),
+                                 host_pitches=(4 * (c1 - c0),))
+        return state
+
+    def quantize(self, state, bits):
+        # One min/max reduction and one quantizing map on the
+        # device; only the small integers come back.
+        r = self.min_max(state).get()
+        (lo, hi) = (float(r['x']), float(r['y']))
+        q = self.cl_array.empty(self.queue, state.shape,
+                                np.uint8 if bits == 8 else np.uint16)
+        self.quantizers[bits](state, q, np.float32(lo),
+                              np.float32(_scale(lo, hi, bits)))
+        return (lo, hi, q.get())
+
+    def stats(self, state):
+        # Reductions run on the device; only three scalars
+        # come back.
+        cl_array = self.cl_array
+        return (float(cl_array.min(state).get()),
+                float(cl_array.max(state).get()),
+                float(cl_array.sum(state).get()) / state.size)
+
+
+def _cluster_backend(**options):
+    import cluster # import cluster.py
+    return cluster.ClusterBackend(**options)
+
+
+backends = { 'futhark': FutharkBackend,
+             'numpy': NumpyBackend,
+             'shm': SharedMemoryBackend,
+             'cluster': _cluster_backend }
+
+
+def make_backend(name=None, **options):
+    """
+    Return the backend called `name`, or auto-detect one
+    if `name` is None or "auto".  `options` are passed to
+    the backend's constructor; options a backend does not
+    use are ignored.
+    """
+    if name and name != 'auto':
+        if name not in backends:
+            raise ValueError("unknown backend: " + name)
+        return backends[name](**options)
+    try:
+        return FutharkBackend(**options)
+    except Exception as e:
+        print("OpenCL not available (" + str(e) + "), using numpy backend")
+        return NumpyBackend(**options)
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+
+"""
+Distributed heat fields over TCP.
+
+A field is split into a grid of blocks, each owned by a
+worker process with its own backend (see backends.py),
+possibly on different machines.  Each worker holds its
+block plus a halo of `halo` rows and columns copied from
+its neighbours.  Every `halo` iterations the workers swap
+edge strips with their neighbours over sockets, first
+east/west and then north/south, so that the corner cells
+arrive too.  Between exchanges the halo cells go stale from
+the outside in, one cell per iteration, which never reaches
+the block itself.
+
+Start the workers with
+
+   $ python cluster.py worker 9001
+   $ python cluster.py worker 9002
+   ...
+
+and point the server at them:
+
+   $ HEAT_BACKEND=cluster HEAT_CLUSTER=host1:9001,host2:9002 \
+     HEAT_CLUSTER_GRID=2x1 python server.py
+
+The coordinator is `ClusterBackend`, so every command of
+server.py works unchanged.
+"""
+
+import json
+import os
+import socket
+import struct
+import threading
+import numpy as np
+
+import backends
+
+
+#### WIRE FORMAT ####
+
+# Every message is a JSON header and an optional binary payload:
+#
+#    u32 header length, u32 payload length, header, payload
+
+def send_msg(sock, header, payload=b''):
+    head = json.dumps(header).encode('utf-8')
+    size = payload.nbytes if hasattr(payload, 'nbytes') else len(payload)
+    sock.sendall(struct.pack('<II', len(head), size) + head)
+    if size:
+        sock.sendall(payload)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:], n - got)
+        if k == 0:
+            raise EOFError("connection closed")
+        got = got + k
+    return buf
+
+
+def recv_msg(sock):
+    (head_len, payload_len) = struct.unpack('<II', bytes(_recv_exact(sock, 8)))
+    header = json.loads(bytes(_recv_exact(sock, head_len)).decode('utf-8'))
+    return (header, _recv_exact(sock, payload_len))
+
+
+def _connect(address):
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+#### GEOMETRY ####
+
+def _splits(n, parts):
+    size = n // parts
+    extra = n % parts
+    bounds = []
+    start = 0
+    for p in range(parts):
+        end = start + size + (1 if p < extra else 0)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def geometry(shape, grid, rank, halo):
+    """
+    The block of `rank` in a field of `shape` split into a
+    grid of (rows, cols) blocks: its own rows r0..r1-1 and
+    columns c0..c1-1, and the rows lo_r..hi_r-1 and columns
+    lo_c..hi_c-1 it holds including the halo.
+    """
+    (rows, cols) = shape
+    (i, j) = divmod(rank, grid[1])
+    (r0, r1) = _splits(rows, grid[0])[i]
+    (c0, c1) = _splits(cols, grid[1])[j]
+    return { 'r0': r0, 'r1': r1, 'c0': c0, 'c1': c1,
+             'lo_r': max(0, r0 - halo), 'hi_r': min(rows, r1 + halo),
+             'lo_c': max(0, c0 - halo), 'hi_c': min(cols, c1 + halo) }
+
+
+def neighbours(grid, rank):
+    (i, j) = divmod(rank, grid[1])
+    n = {}
+    if i > 0:
+        n['N'] = rank - grid[1]
+    if i < grid[0] - 1:
+        n['S'] = rank + grid[1]
+    if j > 0:
+        n['W'] = rank - 1
+    if j < grid[1] - 1:
+        n['E'] = rank + 1
+    return n
+
+
+#### WORKER ####
+
+class Worker(object):
+    """One coordinator session of a worker process."""
+
+    def __init__(self, backend, listener, pending, coordinator, header):
+        self.backend = backend
+        self.coordinator = coordinator
+        self.rank = header['rank']
+        self.grid = tuple(header['grid'])
+        self.fields = {}
+        # Connect to higher-ranked neighbours and wait for the
+        # lower-ranked ones to connect to us.
+        self.peers = {}
+        by_rank = {}
+        for (d, r) in neighbours(self.grid, self.rank).items():
+            if r > self.rank:
+                sock = _connect(tuple(header['peers'][r]))
+                send_msg(sock, {'op': 'hello', 'rank': self.rank})
+                by_rank[r] = sock
+            else:
+                while r not in pending:
+                    (sock, _addr) = listener.accept()
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    (hello, _payload) = recv_msg(sock)
+                    pending[hello['rank']] = sock
+                by_rank[r] = pending.pop(r)
+            self.peers[d] = by_rank[r]
+        send_msg(coordinator, {'op': 'ready'})
+
+    def run(self):
+        ops = { 'load': self.load,
+                'step': self.step,
+                'data': self.data,
+                'crop': self.crop,
+                'free': self.free }
+        try:
+            while True:
+                (header, payload) = recv_msg(self.coordinator)
+                if header['op'] == 'close':
+                    break
+                ops[header['op']](header, payload)
+        except EOFError:
+            pass
+        for sock in self.peers.values():
+            sock.close()
+        self.coordinator.close()
+
+    def load(self, header, payload):
+        g = geometry(header['shape'], self.grid, self.rank, header['halo'])
+        local = np.frombuffer(payload, dtype=np.float32)
+        local = local.reshape(g['hi_r'] - g['lo_r'], g['hi_c'] - g['lo_c'])
+        self.fields[header['fid']] = { 'g': g, 'halo': header['halo'],
+                                       'state': self.backend.upload(local) }
+        send_msg(self.coordinator, {'op': 'ok'})
+
+    def free(self, header, payload):
+        self.fields.pop(header['fid'], None)
+
+    def owned(self, f):
+        # The window of the block itself within the local field.
+        g = f['g']
+        return (g['r0'] - g['lo_r'], g['r1'] - g['lo_r'],
+                g['c0'] - g['lo_c'], g['c1'] - g['lo_c'])
+
+    def exchange(self, f):
+        # Refresh the halo from the neighbours.  Only the edge
+        # strips are read from and written to the backend.
+        g = f['g']
+        k = f['halo']
+        (r0, r1, c0, c1) = self.owned(f)
+        cols = g['hi_c'] - g['lo_c']
+        phases = [ { 'W': ((r0, r1, c0, c0 + k), (r0, r1, c0 - k, c0)),
+                     'E': ((r0, r1, c1 - k, c1), (r0, r1, c1, c1 + k)) },
+                   { 'N': ((r0, r0 + k, 0, cols), (r0 - k, r0, 0, cols)),
+                     'S': ((r1 - k, r1, 0, cols), (r1, r1 + k, 0, cols)) } ]
+        for phase in phases:
+            senders = []
+            for (d, (out, _into)) in phase.items():
+                if d in self.peers:
+                    t = threading.Thread(target=send_msg,
+                                         args=(self.peers[d], {'op': 'halo'},
+                                               self.backend.crop(f['state'], out)))
+                    t.start()
+                    senders.append(t)
+            for (d, (_out, into)) in phase.items():
+                if d in self.peers:
+                    (_header, payload) = recv_msg(self.peers[d])
+                    strip = np.frombuffer(payload, dtype=np.float32)
+                    strip = strip.reshape(into[1] - into[0], into[3] - into[2])
+                    f['state'] = self.backend.paste(f['state'], into, strip)
+            for t in senders:
+                t.join()
+
+    def step(self, header, payload):
+        f = self.fields[header['fid']]
+        (iterations, beta) = (header['iterations'], header['beta'])
+        backend = self.backend
+        change = 0.0
+        remaining = iterations
+        while remaining > 0:
+            k = min(f['halo'], remaining)
+            self.exchange(f)
+            state = f['state']
+            if header.get('delta') and k == remaining:
+                # The halo changes too, but only the block counts.
+                state = backend.step(state, k - 1, beta)
+                before = backend.crop(state, self.owned(f))
+                state = backend.step(state, 1, beta)
+                after = backend.crop(state, self.owned(f))
+                change = float(np.abs(after - before).max())
+            else:
+                state = backend.step(state, k, beta)
+            f['state'] = state
+            remaining = remaining - k
+        send_msg(self.coordinator, {'op': 'done', 'delta': change})
+
+    def data(self, header, payload):
+        f = self.fields[header['fid']]
+        send_msg(self.coordinator, {'op': 'data'}, self.backend.crop(f['state'], self.owned(f)))
+
+    def crop(self, header, payload):
+        # `window` is in field coordinates, within the block.
+        f = self.fields[header['fid']]
+        g = f['g']
+        (r0, r1, c0, c1) = header['window']
+        window = (r0 - g['lo_r'], r1 - g['lo_r'], c0 - g['lo_c'], c1 - g['lo_c'])
+        send_msg(self.coordinator, {'op': 'data'}, self.backend.crop(f['state'], window))
+
+
+def serve(port, backend_name=None):
+    backend = backends.make_backend(backend_name)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', port))
+    listener.listen(16)
+    print("Cluster worker on port " + str(port) + " (" + backend.name + " backend)")
+    pending = {}
+    while True:
+        (sock, _addr) = listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        (header, _payload) = recv_msg(sock)
+        if header['op'] == 'hello':
+            # A neighbour that got its 'connect' before we did.
+            pending[header['rank']] = sock
+        elif header['op'] == 'connect':
+            Worker(backend, listener, pending, sock, header).run()
+
+
+#### COORDINATOR ####
+
+class ClusterField(object):
+
+    def __init__(self, backend, fid, shape):
+        self.backend = backend
+        self.fid = fid
+        self.shape = shape
+        self.nbytes = 0
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.broadcast({'op': 'free', 'fid': self.fid})
+            self.backend = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ClusterBackend(object):
+    """
+    Coordinator: splits fields over the workers listed in
+    `cluster` ("host:port,host:port,...") arranged as a
+    `grid` ("RxC", default one column), exchanging halos of
+    width `halo` every `halo` iterations.
+    """
+
+    name = 'cluster'
+    host_sized = False
+
+    def __init__(self, cluster=None, grid=None, halo=4, **options):
+        cluster = cluster or os.environ.get('HEAT_CLUSTER', '')
+        addresses = []
+        for a in cluster.split(','):
+            (host, port) = a.strip().rsplit(':', 1)
+            addresses.append((host, int(port)))
+        if grid:
+            self.grid = tuple(int(x) for x in grid.lower().split('x'))
+        else:
+            self.grid = (len(addresses), 1)
+        if self.grid[0] * self.grid[1] != len(addresses):
+            raise ValueError("cluster grid " + str(self.grid) + " does not match "
+                             + str(len(addresses)) + " workers")
+        self.halo = halo
+        self.next_fid = 0
+        self.workers = [_connect(a) for a in addresses]
+        peers = [list(a) for a in addresses]
+        for (rank, sock) in enumerate(self.workers):
+            send_msg(sock, {'op': 'connect', 'rank': rank,
+                            'grid': list(self.grid), 'peers': peers})
+        for sock in self.workers:
+            recv_msg(sock)
+
+    def broadcast(self, header):
+        for sock in self.workers:
+            send_msg(sock, header)
+
+    def gather(self):
+        return [recv_msg(sock) for sock in self.workers]
+
+    def check_shape(self, shape):
+        """Raise ValueError unless a field of `shape` can be split over the grid."""
+        if len(shape) != 2:
+            raise ValueError("the cluster backend only holds 2D fields")
+        for rank in range(len(self.workers)):
+            g = geometry(shape, self.grid, rank, self.halo)
+            if min(g['r1'] - g['r0'], g['c1'] - g['c0']) < self.halo:
+                raise ValueError("a " + "x".join(str(n) for n in shape)
+                                 + " field split over a " + "x".join(str(n) for n in self.grid)
+                                 + " grid has blocks thinner than the halo of "
+                                 + str(self.halo) + "; use a larger field, a smaller"
+                                 + " HEAT_CLUSTER_GRID or a smaller HEAT_CLUSTER_HALO")
+
+    def upload(self, array):
+        array = np.asarray(array, dtype=np.float32)
+        # Check every block before any worker is sent one.
+        self.check_shape(array.shape)
+        fid = self.next_fid
+        self.next_fid = fid + 1
+        for (rank, sock) in enumerate(self.workers):
+            g = geometry(array.shape, self.grid, rank, self.halo)
+            local = np.ascontiguousarray(array[g['lo_r']:g['hi_r'], g['lo_c']:g['hi_c']])
+            send_msg(sock, {'op': 'load', 'fid': fid, 'shape': list(array.shape),
+                            'halo': self.halo}, local)
+        self.gather()
+        return ClusterField(self, fid, array.shape)
+
+    def download(self, field):
+        self.broadcast({'op': 'data', 'fid': field.fid})
+        out = np.empty(field.shape, dtype=np.float32)
+        for (rank, (_header, payload)) in enumerate(self.gather()):
+            g = geometry(field.shape, self.grid, rank, self.halo)
+            block = out[g['r0']:g['r1'], g['c0']:g['c1']]
+            block[...] = np.frombuffer(payload, dtype=np.float32).reshape(block.shape)
+        return out
+
+    def step(self, field, iterations, beta):
+        self.broadcast({'op': 'step', 'fid': field.fid,
+                        'iterations': int(iterations), 'beta': float(beta)})
+        self.gather()
+        return field
+
+    def step_delta(self, field, beta):
+        self.broadcast({'op': 'step', 'fid': field.fid, 'iterations': 1,
+                        'beta': float(beta), 'delta': True})
+        return (field, max(h['delta'] for (h, _p) in self.gather()))
+
+    def render(self, field):
+        return backends.png_red(self.download(field))
+
+    def stats(self, field):
+        return backends.field_stats(self.download(field))
+
+    def quantize(self, field, bits):
+        return backends.quantize_array(self.download(field), bits)
+
+    def mipmap(self, field, levels):
+        return backends.mipmap_array(self.download(field), levels)
+
+    def lod(self, pyramid, level, window=None):
+        return backends.crop_array(pyramid[level - 1], window)
+
+    def crop(self, field, window):
+        # Only the workers whose blocks overlap the window are
+        # asked, each for its part of it.
+        (r0, r1, c0, c1) = window
+        out = np.empty((r1 - r0, c1 - c0), dtype=np.float32)
+        parts = []
+        for (rank, sock) in enumerate(self.workers):
+            g = geometry(field.shape, self.grid, rank, self.halo)
+            part = (max(r0, g['r0']), min(r1, g['r1']), max(c0, g['c0']), min(c1, g['c1']))
+            if part[0] < part[1] and part[2] < part[3]:
+                send_msg(sock, {'op': 'crop', 'fid': field.fid, 'window': list(part)})
+                parts.append((sock, part))
+        for (sock, (pr0, pr1, pc0, pc1)) in parts:
+            (_header, payload) = recv_msg(sock)
+            block = out[pr0 - r0:pr1 - r0, pc0 - c0:pc1 - c0]
+            block[...] = np.frombuffer(payload, dtype=np.float32).reshape(block.shape)
+        return out
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    if len(argv) >= 3 and argv[1] == 'worker':
+        serve(int(argv[2]), argv[3] if len(argv) > 3 else os.environ.get('HEAT_BACKEND'))
+    else:
+        print("usage: python cluster.py worker PORT [BACKEND]")
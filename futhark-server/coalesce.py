@@ -0,0 +1,63 @@
+"""
+Coalescing of concurrent identical requests.
+
+When several viewers of one session ask for the same
+`step` at about the same time, the first request waits
+`window` seconds for others to arrive, then runs once;
+every request that arrives before the result is ready
+gets that same result.  The simulation advances once
+and all viewers see the same frame.
+
+Requests are matched by a key, normally the full command
+string, which includes the session.  This is the version
+for the threaded server.py; aioserver.py has an asyncio
+one.
+"""
+
+import threading
+import time
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 1
+
+
+class Coalescer(object):
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def run(self, key, fn):
+        """fn(), or the result of a concurrent call with the same key."""
+        with self.lock:
+            call = self.pending.get(key)
+            leader = call is None
+            if leader:
+                call = self.pending[key] = _Call()
+            else:
+                call.waiters = call.waiters + 1
+        if leader:
+            if self.window > 0:
+                time.sleep(self.window)
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.pending[key]
+                if call.waiters > 1:
+                    print("coalesced " + str(call.waiters) + " x " + str(key))
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
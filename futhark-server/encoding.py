@@ -0,0 +1,136 @@
+"""
+HTTP Content-Encoding for server replies.
+
+`negotiate(accept)` picks an encoding from a request's
+Accept-Encoding header:
+
+   gzip, deflate   zlib; fast, understood by every browser
+   xz              lzma; much slower, for archival downloads
+                   of whole fields (needs the lzma module,
+                   i.e. Python 3)
+
+Ties in the client's q-values go to the earlier entry
+above.  Replies shorter than MIN_BYTES are sent as they
+are.
+
+`stream(body, encoding, write)` compresses `body` in
+CHUNK_BYTES pieces on a worker thread and hands each
+compressed piece to `write` as soon as it is ready, so the
+first bytes go out while the rest of a large field is
+still being compressed.  zlib and lzma release the GIL
+while they work.
+"""
+
+import threading
+import zlib
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+MIN_BYTES = 1024
+CHUNK_BYTES = 1 << 18
+
+# Compressed pieces waiting to be written.
+QUEUE_CHUNKS = 4
+
+
+def available():
+    names = ['gzip', 'deflate']
+    if lzma is not None:
+        names.append('xz')
+    return names
+
+
+def negotiate(accept, size=None):
+    """The encoding to use for `accept`, or None for identity."""
+    if not accept or (size is not None and size < MIN_BYTES):
+        return None
+    q = {}
+    for item in accept.split(','):
+        (name, _sep, params) = item.strip().partition(';')
+        weight = 1.0
+        for param in params.split(';'):
+            (key, _sep, value) = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        q[name.strip().lower()] = weight
+    best = None
+    for name in available():
+        weight = q.get(name, q.get('*', 0.0))
+        if weight > 0 and (best is None or weight > best[0]):
+            best = (weight, name)
+    return best and best[1]
+
+
+def compressor(encoding):
+    if encoding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        return zlib.compressobj(6)
+    elif encoding == 'xz':
+        return lzma.LZMACompressor()
+    raise ValueError("unknown encoding " + repr(encoding))
+
+
+def chunks(body, encoding, size=CHUNK_BYTES):
+    """The pieces of `body` compressed with `encoding`."""
+    c = compressor(encoding)
+    for i in range(0, len(body), size):
+        piece = c.compress(body[i:i + size])
+        if piece:
+            yield piece
+    yield c.flush()
+
+
+# HTTP/1.1 chunked transfer coding, for compressed replies
+# whose length isn't known when the headers go out.
+LAST_CHUNK = b'0\r\n\r\n'
+
+
+def chunk(piece):
+    if not piece:
+        return b''
+    return ('%x\r\n' % len(piece)).encode('latin-1') + piece + b'\r\n'
+
+
+def stream(body, encoding, write, size=CHUNK_BYTES):
+    """write() `body` compressed, piece by piece, as a worker thread produces it."""
+    pieces = Queue(QUEUE_CHUNKS)
+    stopped = threading.Event()
+
+    def work():
+        try:
+            for piece in chunks(body, encoding, size):
+                if stopped.is_set():
+                    break
+                pieces.put(piece)
+        finally:
+            pieces.put(None)
+
+    worker = threading.Thread(target=work)
+    worker.daemon = True
+    worker.start()
+    piece = b''
+    try:
+        while True:
+            piece = pieces.get()
+            if piece is None:
+                break
+            write(piece)
+    finally:
+        # If write() failed, let the worker finish and exit.
+        stopped.set()
+        while piece is not None:
+            piece = pieces.get()
+        worker.join()
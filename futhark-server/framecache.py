@@ -0,0 +1,56 @@
+"""
+A cache of recent frames shared by all sessions.
+
+Entries are keyed by (session id, frame id, form), where
+the frame id is the session's step count and the form is
+FIELD for the host copy of the field or the format
+options of an encoded reply (see frames.py).  Repeating a
+request, or asking for a frame after the simulation has
+moved on (`data=frame:<k>`), is answered from here
+without touching the device.
+
+The cache holds at most `max_bytes`; when it is over, the
+oldest entries are dropped first, like a ring buffer.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+# The form of the host copy of a field.
+FIELD = None
+
+
+class FrameGone(Exception):
+    """The requested frame is no longer cached."""
+
+
+def _size(value):
+    return value.nbytes if hasattr(value, 'nbytes') else len(value)
+
+
+class FrameCache(object):
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, value):
+        size = _size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes = self.nbytes - _size(old)
+            self.entries[key] = value
+            self.nbytes = self.nbytes + size
+            while self.nbytes > self.max_bytes:
+                (_key, oldest) = self.entries.popitem(last=False)
+                self.nbytes = self.nbytes - _size(oldest)
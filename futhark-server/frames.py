@@ -0,0 +1,235 @@
+"""
+Encodings of the field for `data` and `step`.
+
+Commands take an optional, comma separated list of format
+options after their arguments:
+
+   data=<options>        e.g.  data=delta:41
+   step=<n>,<options>    e.g.  step=10,qdelta:41
+
+With no options the reply is the raw float32 field, as
+before.  The options are
+
+   lod:<k>        level of detail k: the field averaged over
+                  2^k x 2^k blocks, ceil(rows/2^k) x
+                  ceil(cols/2^k) float32 values
+   roi:<r0>:<r1>:<c0>:<c1>
+                  only rows r0 to r1 - 1 and columns c0 to
+                  c1 - 1 (of level k with lod:<k>), clipped
+                  to the field, row by row
+   u8, u16        the field quantized to 8 or 16 bits
+   delta:<base>   lossless delta against frame <base>
+   qdelta:<base>  delta of the field quantized to steps of
+                  2^-16, against frame <base>
+   frame:<k>      frame k instead of the current one, if it
+                  is still in the frame cache (framecache.py);
+                  only with `data`
+
+Encoded replies are kept in the frame cache, so asking
+again for the same frame in the same form costs no device
+work.
+
+u8 and u16 replies are two little-endian float32 values,
+min and max, followed by one unsigned 8 or 16 bit
+(little-endian) value per cell,
+
+   q = round((x - min) / (max - min) * (2^bits - 1))
+
+so x ~ min + q * (max - min) / (2^bits - 1).  They are
+computed where the field lives; the float field itself
+is never read back.  With lod or roi they quantize the
+selected values instead.  delta and qdelta always refer to
+the full field.
+
+A frame id is the session's step count (`status` reports
+it).  Delta replies start with a 20 byte little-endian
+header
+
+   u8 mode, 3 bytes padding, i32 frame id, i32 base id,
+   u32 rows, u32 cols
+
+followed by a zlib stream.  For mode 1 (delta) the stream
+holds the float32 bit patterns XORed with those of the
+base frame; for mode 2 (qdelta) it holds the int32
+differences d = round(2^16 * x) - round(2^16 * base),
+zigzag encoded as (d << 1) ^ (d >> 31) so that small
+negative differences are small numbers too.  In both cases the
+four bytes of each value are stored as four separate planes
+(all first bytes, then all second bytes, ...) so that the
+mostly-zero high bytes compress well.  If the server no
+longer has the base frame, base id is -1 and the stream is
+relative to an all-zero frame, i.e. a key frame the client
+can resynchronize from.  qdelta needs |x| < 2^15 (and no
+NaN or infinity); a field outside that range is sent as a
+mode 1 key frame instead, and a base outside it is treated
+as missing.
+"""
+
+import struct
+import zlib
+from collections import OrderedDict
+import numpy as np
+import backends
+from framecache import FIELD, FrameGone
+
+
+DELTA = 1
+QDELTA = 2
+
+QUANTUM = 1 << 16
+
+
+def parse_options(options):
+    """{'delta': '41', ...} from ['delta:41', ...]."""
+    result = OrderedDict()
+    for option in options:
+        if option:
+            (name, _sep, value) = option.partition(':')
+            result[name] = value
+    return result
+
+
+def lod_levels(shape):
+    """How many times a field of `shape` can be halved."""
+    levels = 0
+    size = max(shape)
+    while size > 1:
+        size = (size + 1) // 2
+        levels = levels + 1
+    return levels
+
+
+def parse_window(value):
+    """(r0, r1, c0, c1) from 'r0:r1:c0:c1'."""
+    window = tuple(int(x) for x in value.split(':'))
+    if len(window) != 4:
+        raise ValueError("roi needs r0:r1:c0:c1, got " + repr(value))
+    return window
+
+
+def clip_window(window, shape):
+    (rows, cols) = shape[-2:]
+    (r0, r1, c0, c1) = window
+    r0 = min(max(r0, 0), rows)
+    c0 = min(max(c0, 0), cols)
+    return (r0, min(max(r1, r0), rows), c0, min(max(c1, c0), cols))
+
+
+def _planes(array):
+    # The bytes of 4-byte values as four planes.
+    return array.view(np.uint8).reshape(-1, 4).T.tobytes()
+
+
+def _quantize(field):
+    # None if some value does not fit in an int32.
+    q = np.rint(field.astype(np.float64) * QUANTUM)
+    if not np.all(np.abs(q) < 2.0 ** 31):
+        return None
+    return q.astype(np.int32)
+
+
+def encode_delta(mode, frame_id, field, base_id, base):
+    if base is None:
+        base_id = -1
+    if mode == DELTA:
+        cur = field.view(np.uint32)
+        diff = cur if base is None else cur ^ base.view(np.uint32)
+    else:
+        cur = _quantize(field)
+        if cur is None:
+            return encode_delta(DELTA, frame_id, field, -1, None)
+        old = None if base is None else _quantize(base)
+        if old is None:
+            base_id = -1
+        diff = cur if old is None else cur - old
+        diff = (diff << 1) ^ (diff >> 31)
+    (rows, cols) = field.shape
+    head = struct.pack('<B3xiiII', mode, frame_id, base_id, rows, cols)
+    return head + zlib.compress(_planes(diff), 1)
+
+
+def _quantized(bits, lo, hi, q):
+    return struct.pack('<ff', lo, hi) + q.astype('<u' + str(bits // 8), copy=False).tobytes()
+
+
+class _Current(object):
+    # The session's current frame, wherever it lives.
+
+    def __init__(self, backend, d):
+        self.backend = backend
+        self.d = d
+
+    def field(self):
+        return self.d.field()
+
+    def level(self, k, window):
+        return self.d.level(k, window)
+
+    def quantize(self, bits):
+        return self.backend.quantize(self.d.state, bits)
+
+
+class _Past(object):
+    # An earlier frame, from its host copy in the cache.
+
+    def __init__(self, field):
+        self.host = field
+
+    def field(self):
+        return self.host
+
+    def level(self, k, window):
+        array = self.host
+        k = min(k, lod_levels(array.shape))
+        if k > 0:
+            array = backends.mipmap_array(array, k)[-1]
+        if window is not None:
+            array = backends.crop_array(array, clip_window(window, array.shape))
+        return array
+
+    def quantize(self, bits):
+        return backends.quantize_array(self.host, bits)
+
+
+def _encode(frame, frame_id, session_id, opts, cache):
+    bits = 8 if 'u8' in opts else 16 if 'u16' in opts else None
+    lod = int(opts.get('lod') or 0)
+    window = parse_window(opts['roi']) if 'roi' in opts else None
+    if lod > 0 or window is not None:
+        # Levels and windows are small; quantize them on
+        # the host.
+        level = frame.level(lod, window)
+        if bits:
+            return _quantized(bits, *backends.quantize_array(level, bits))
+        return level.tobytes()
+    if bits:
+        return _quantized(bits, *frame.quantize(bits))
+    field = frame.field()
+    for (name, mode) in (('delta', DELTA), ('qdelta', QDELTA)):
+        if name in opts:
+            base_id = int(opts[name])
+            base = cache.get((session_id, base_id, FIELD))
+            return encode_delta(mode, frame_id, field, base_id, base)
+    return field.tobytes()
+
+
+def encode(backend, d, options, cache):
+    """The reply for `data`/`step` on session `d`, using the frame cache."""
+    opts = parse_options(options)
+    frame_id = int(opts.pop('frame')) if 'frame' in opts else d.count
+    form = ','.join(name + (':' + value if value else '') for (name, value) in opts.items())
+    if form:
+        body = cache.get((d.id, frame_id, form))
+        if body is not None:
+            return body
+    if frame_id == d.count:
+        frame = _Current(backend, d)
+    else:
+        field = cache.get((d.id, frame_id, FIELD))
+        if field is None:
+            raise FrameGone("frame " + str(frame_id) + " is no longer available")
+        frame = _Past(field)
+    body = _encode(frame, frame_id, d.id, opts, cache)
+    if form:
+        cache.put((d.id, frame_id, form), body)
+    return body
@@ -2234,7 +2234,9 @@ def futhark_from_bits32(x):
   s = struct.pack('>l', x)
   return np.float32(struct.unpack('>f', s)[0])
 class heat:
-  entry_points = {"main": (["i32", "f32", "[][]f32"], ["[][]f32", "[][][]u8"])}
+  entry_points = {"main": (["i32", "f32", "[][]f32"], ["[][]f32", "[][][]u8"]),
+                  "step": (["i32", "f32", "[][]f32"], ["[][]f32"]),
+                  "render": (["[][]f32"], ["[][][]u8"])}
   def __init__(self, command_queue=None, interactive=False,
                platform_pref=preferred_platform, device_pref=preferred_device,
                default_group_size=default_group_size,
@@ -2280,6 +2282,20 @@ class heat:
     self.map_5311_var = program.map_5311
   def futhark_main(self, field_mem_sizze_5329, field_mem_5330, sizze_5165,
                    sizze_5166, iterations_5167, beta_5168):
+    (res_mem_sizze_5342, res_mem_5343) = self.futhark_step(field_mem_sizze_5329,
+                                                           field_mem_5330,
+                                                           sizze_5165, sizze_5166,
+                                                           iterations_5167,
+                                                           beta_5168)
+    (out_memsizze_5358, out_mem_5357) = self.futhark_render(res_mem_5343,
+                                                            sizze_5165,
+                                                            sizze_5166)
+    return (res_mem_sizze_5342, res_mem_5343, sizze_5165, sizze_5166,
+            out_memsizze_5358, out_mem_5357, sizze_5165, sizze_5166,
+            np.int32(3))
+  # The loop of futhark_main (entry step in heat.fut).
+  def futhark_step(self, field_mem_sizze_5329, field_mem_5330, sizze_5165,
+                   sizze_5166, iterations_5167, beta_5168):
     loop_nonempty_5170 = slt32(np.int32(0), iterations_5167)
     range_end_5171 = (sizze_5165 - np.int32(1))
     bounds_invalid_upwards_5172 = slt32(range_end_5171, np.int32(0))
@@ -2342,6 +2358,12 @@ class heat:
     bytes_5337 = (np.int64(4) * binop_x_5339)
     field_mem_sizze_5331 = field_mem_sizze_5329
     field_mem_5332 = field_mem_5330
+    # Ping-pong: the kernel writes into whichever of mem_5336 and
+    # mem_5340 does not hold the current field, and the two are
+    # swapped after each iteration.  The input field_mem_5330 is
+    # only ever read, so no per-iteration allocation or copy is
+    # needed.
+    mem_5340 = opencl_alloc(self, bytes_5337, "mem_5340")
     _i_5210 = np.int32(0)
     one_5371 = np.int32(1)
     for counter_5370 in range(iterations_5167):
@@ -2357,22 +2379,21 @@ class heat:
                                    (np.long(group_sizze_5254),))
         if synchronous:
           self.queue.finish()
-      mem_5340 = opencl_alloc(self, bytes_5337, "mem_5340")
-      if (((sizze_5165 * sizze_5166) * np.int32(4)) != 0):
-        cl.enqueue_copy(self.queue, mem_5340, mem_5336,
-                        dest_offset=np.long(np.int32(0)),
-                        src_offset=np.long(np.int32(0)),
-                        byte_count=np.long(((sizze_5165 * sizze_5166) * np.int32(4))))
-      if synchronous:
-        self.queue.finish()
-      field_mem_sizze_tmp_5362 = bytes_5337
-      field_mem_tmp_5363 = mem_5340
+      field_mem_sizze_tmp_5362 = bytes_5333
+      field_mem_tmp_5363 = mem_5336
+      mem_5336 = mem_5340
+      mem_5340 = field_mem_tmp_5363
       field_mem_sizze_5331 = field_mem_sizze_tmp_5362
       field_mem_5332 = field_mem_tmp_5363
       _i_5210 += one_5371
     res_mem_sizze_5342 = field_mem_sizze_5331
     res_mem_5343 = field_mem_5332
     mem_5336 = None
+    mem_5340 = None
+    return (res_mem_sizze_5342, res_mem_5343)
+  # The rendering map of futhark_main (entry render in heat.fut).
+  def futhark_render(self, res_mem_5343, sizze_5165, sizze_5166):
+    convop_x_5338 = (sizze_5165 * sizze_5166)
     group_sizze_5306 = self.sizes["main.group_size_5305"]
     y_5307 = (group_sizze_5306 - np.int32(1))
     x_5308 = (y_5307 + convop_x_5338)
@@ -2393,31 +2414,10 @@ class heat:
       if synchronous:
         self.queue.finish()
     mem_5345 = None
-    out_arrsizze_5355 = sizze_5165
-    out_arrsizze_5356 = sizze_5166
-    out_arrsizze_5359 = sizze_5165
-    out_arrsizze_5360 = sizze_5166
-    out_arrsizze_5361 = np.int32(3)
-    out_memsizze_5354 = res_mem_sizze_5342
-    out_mem_5353 = res_mem_5343
-    out_memsizze_5358 = bytes_5346
-    out_mem_5357 = mem_5349
-    return (out_memsizze_5354, out_mem_5353, out_arrsizze_5355,
-            out_arrsizze_5356, out_memsizze_5358, out_mem_5357,
-            out_arrsizze_5359, out_arrsizze_5360, out_arrsizze_5361)
-  def main(self, iterations_5167_ext, beta_5168_ext, field_mem_5330_ext):
-    try:
-      iterations_5167 = np.int32(ct.c_int32(iterations_5167_ext))
-    except (TypeError, AssertionError) as e:
-      raise TypeError("Argument #0 has invalid value\nFuthark type: {}\nArgument has Python type {} and value: {}\n".format("i32",
-                                                                                                                            type(iterations_5167_ext),
-                                                                                                                            iterations_5167_ext))
-    try:
-      beta_5168 = np.float32(ct.c_float(beta_5168_ext))
-    except (TypeError, AssertionError) as e:
-      raise TypeError("Argument #1 has invalid value\nFuthark type: {}\nArgument has Python type {} and value: {}\n".format("f32",
-                                                                                                                            type(beta_5168_ext),
-                                                                                                                            beta_5168_ext))
+    return (bytes_5346, mem_5349)
+  # The device buffer and shape of a [][]f32 argument,
+  # copied to the device if it is a numpy array.
+  def field_arg(self, field_mem_5330_ext, position):
     try:
       assert ((type(field_mem_5330_ext) in [np.ndarray,
                                             cl.array.Array]) and (field_mem_5330_ext.dtype == np.float32)), "Parameter has unexpected type"
@@ -2434,9 +2434,26 @@ class heat:
                           normaliseArray(field_mem_5330_ext),
                           is_blocking=synchronous)
     except (TypeError, AssertionError) as e:
-      raise TypeError("Argument #2 has invalid value\nFuthark type: {}\nArgument has Python type {} and value: {}\n".format("[][]f32",
+      raise TypeError("Argument #{} has invalid value\nFuthark type: {}\nArgument has Python type {} and value: {}\n".format(position,
+                                                                                                                            "[][]f32",
                                                                                                                             type(field_mem_5330_ext),
                                                                                                                             field_mem_5330_ext))
+    return (field_mem_sizze_5329, field_mem_5330, sizze_5165, sizze_5166)
+  def main(self, iterations_5167_ext, beta_5168_ext, field_mem_5330_ext):
+    try:
+      iterations_5167 = np.int32(ct.c_int32(iterations_5167_ext))
+    except (TypeError, AssertionError) as e:
+      raise TypeError("Argument #0 has invalid value\nFuthark type: {}\nArgument has Python type {} and value: {}\n".format("i32",
+                                                                                                                            type(iterations_5167_ext),
+                                                                                                                            iterations_5167_ext))
+    try:
+      beta_5168 = np.float32(ct.c_float(beta_5168_ext))
+    except (TypeError, AssertionError) as e:
+      raise TypeError("Argument #1 has invalid value\nFuthark type: {}\nArgument has Python type {} and value: {}\n".format("f32",
+                                                                                                                            type(beta_5168_ext),
+                                                                                                                            beta_5168_ext))
+    (field_mem_sizze_5329, field_mem_5330, sizze_5165,
+     sizze_5166) = self.field_arg(field_mem_5330_ext, 2)
     (out_memsizze_5354, out_mem_5353, out_arrsizze_5355, out_arrsizze_5356,
      out_memsizze_5358, out_mem_5357, out_arrsizze_5359, out_arrsizze_5360,
      out_arrsizze_5361) = self.futhark_main(field_mem_sizze_5329,
@@ -2447,4 +2464,34 @@ class heat:
                            ct.c_float, data=out_mem_5353),
             cl.array.Array(self.queue, (out_arrsizze_5359, out_arrsizze_5360,
                                         out_arrsizze_5361), ct.c_uint8,
-                           data=out_mem_5357))
\ No newline at end of file
+                           data=out_mem_5357))
+  def step(self, iterations_5167_ext, beta_5168_ext, field_mem_5330_ext):
+    try:
+      iterations_5167 = np.int32(ct.c_int32(iterations_5167_ext))
+    except (TypeError, AssertionError) as e:
+      raise TypeError("Argument #0 has invalid value\nFuthark type: {}\nArgument has Python type {} and value: {}\n".format("i32",
+                                                                                                                            type(iterations_5167_ext),
+                                                                                                                            iterations_5167_ext))
+    try:
+      beta_5168 = np.float32(ct.c_float(beta_5168_ext))
+    except (TypeError, AssertionError) as e:
+      raise TypeError("Argument #1 has invalid value\nFuthark type: {}\nArgument has Python type {} and value: {}\n".format("f32",
+                                                                                                                            type(beta_5168_ext),
+                                                                                                                            beta_5168_ext))
+    (field_mem_sizze_5329, field_mem_5330, sizze_5165,
+     sizze_5166) = self.field_arg(field_mem_5330_ext, 2)
+    (out_memsizze_5354, out_mem_5353) = self.futhark_step(field_mem_sizze_5329,
+                                                          field_mem_5330,
+                                                          sizze_5165, sizze_5166,
+                                                          iterations_5167,
+                                                          beta_5168)
+    return cl.array.Array(self.queue, (sizze_5165, sizze_5166), ct.c_float,
+                          data=out_mem_5353)
+  def render(self, field_mem_5330_ext):
+    (field_mem_sizze_5329, field_mem_5330, sizze_5165,
+     sizze_5166) = self.field_arg(field_mem_5330_ext, 0)
+    (out_memsizze_5358, out_mem_5357) = self.futhark_render(field_mem_5330,
+                                                            sizze_5165,
+                                                            sizze_5166)
+    return cl.array.Array(self.queue, (sizze_5165, sizze_5166, np.int32(3)),
+                          ct.c_uint8, data=out_mem_5357)
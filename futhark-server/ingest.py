@@ -0,0 +1,150 @@
+"""
+Reading an uploaded initial field.
+
+A field is POSTed to /upload, optionally followed by the
+format and, for raw data, the shape:
+
+   /upload                  format from the first bytes
+   /upload=npy              a .npy file
+   /upload=futhark          Futhark's binary data format
+   /upload=raw,1000x2000    float32 values, row by row; without
+                            a shape the field must be square
+
+npy and Futhark values of any numeric type are converted to
+float32 as they arrive; the field must be two-dimensional
+and at least MIN_SIDE x MIN_SIDE, since the border is fixed
+and only the interior is stepped.
+The body is copied in CHUNK_BYTES pieces into a float32
+memmap backed by an anonymous temporary file (see TMPDIR),
+so an upload of several GB never has to fit in memory.
+"""
+
+import ast
+import struct
+import tempfile
+import numpy as np
+
+
+CHUNK_BYTES = 1 << 20
+
+MIN_SIDE = 3
+
+NPY_MAGIC = b'\x93NUMPY'
+
+# Type names of the Futhark binary data format.
+FUTHARK_TYPES = { '  i8': 'i1', ' i16': '<i2', ' i32': '<i4', ' i64': '<i8',
+                  '  u8': 'u1', ' u16': '<u2', ' u32': '<u4', ' u64': '<u8',
+                  ' f16': '<f2', ' f32': '<f4', ' f64': '<f8', 'bool': '?'}
+
+
+def parse_args(arg):
+    """(format, shape) from 'raw,1000x2000' and the like."""
+    fmt = None
+    shape = None
+    for option in arg.split(','):
+        if 'x' in option:
+            shape = tuple(int(x) for x in option.split('x'))
+        elif option:
+            fmt = option
+    return (fmt, shape)
+
+
+def _read_exactly(read, n):
+    parts = []
+    while n > 0:
+        part = read(min(n, CHUNK_BYTES))
+        if not part:
+            raise ValueError("upload ended early")
+        parts.append(part)
+        n = n - len(part)
+    return b''.join(parts)
+
+
+def _npy_header(head, read):
+    # head is the 6 byte magic string.
+    (major, _minor) = struct.unpack('<BB', _read_exactly(read, 2))
+    if major == 1:
+        (size,) = struct.unpack('<H', _read_exactly(read, 2))
+        used = 10
+    else:
+        (size,) = struct.unpack('<I', _read_exactly(read, 4))
+        used = 12
+    header = ast.literal_eval(_read_exactly(read, size).decode('latin-1'))
+    return (np.dtype(header['descr']), tuple(header['shape']),
+            header['fortran_order'], used + size)
+
+
+def _futhark_header(head, read):
+    # head is 'b', version 2, the rank and 3 of the 4
+    # characters of the type name.
+    (rank,) = struct.unpack('<b', head[2:3])
+    name = (head[3:6] + _read_exactly(read, 1)).decode('latin-1')
+    if name not in FUTHARK_TYPES:
+        raise ValueError("unknown Futhark type " + repr(name))
+    shape = struct.unpack('<' + 'Q' * rank, _read_exactly(read, 8 * rank))
+    return (np.dtype(FUTHARK_TYPES[name]), shape, False, 7 + 8 * rank)
+
+
+def sniff(head):
+    if head.startswith(NPY_MAGIC):
+        return 'npy'
+    elif head[:2] == b'b\x02':
+        return 'futhark'
+    return 'raw'
+
+
+def read_field(read, length, fmt=None, shape=None):
+    """
+    A [rows][cols] float32 memmap holding the field in the
+    next `length` bytes of read(n).
+    """
+    head = _read_exactly(read, min(length, 6))
+    fmt = fmt or sniff(head)
+    if fmt == 'npy':
+        (dtype, shape, fortran, used) = _npy_header(head, read)
+        head = b''
+    elif fmt == 'futhark':
+        (dtype, shape, fortran, used) = _futhark_header(head, read)
+        head = b''
+    elif fmt == 'raw':
+        (dtype, fortran, used) = (np.dtype('<f4'), False, 0)
+        if shape is None:
+            n = int(round((length // 4) ** 0.5))
+            shape = (n, n)
+    else:
+        raise ValueError("unknown upload format " + repr(fmt))
+    if len(shape) != 2:
+        raise ValueError("the field must be 2D, got shape " + repr(shape))
+    if min(shape) < MIN_SIDE:
+        raise ValueError("the field must be at least " + str(MIN_SIDE) + "x"
+                         + str(MIN_SIDE) + ", got shape " + repr(tuple(shape)))
+    size = shape[0] * shape[1] * dtype.itemsize
+    if length - used != size:
+        raise ValueError("expected " + str(size) + " bytes of " + str(dtype)
+                         + " for shape " + repr(shape) + ", got " + str(length - used))
+    out = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+',
+                    shape=shape[::-1] if fortran else shape)
+    flat = out.reshape(-1)
+    _copy(head, read, size, dtype, flat)
+    return out.T if fortran else out
+
+
+def _copy(head, read, size, dtype, flat):
+    # Convert whole values only; a partial one waits for
+    # the next piece.
+    pending = head
+    done = 0
+    left = size - len(head)
+    while True:
+        whole = len(pending) - len(pending) % dtype.itemsize
+        values = np.frombuffer(pending[:whole], dtype=dtype)
+        flat[done:done + values.size] = values
+        done = done + values.size
+        pending = pending[whole:]
+        if left <= 0:
+            break
+        part = read(min(left, CHUNK_BYTES))
+        if not part:
+            raise ValueError("upload ended early")
+        left = left - len(part)
+        pending = pending + part
@@ -0,0 +1,120 @@
+"""
+Steady-state solver for the heat kernel.
+
+Repeated application of `newField` (see heat.fut) converges
+to the field in which every interior cell is the average of
+its four neighbours, i.e. the solution of Laplace's equation
+with the edges of the field as (Dirichlet) boundary values.
+Reaching it by iteration takes O(n^2) steps; `solve` computes
+it directly with geometric multigrid V-cycles.
+
+The grids need not have 2^k+1 points.  Each coarse level has
+about half as many interior points per axis, laid out evenly
+over the same domain, and levels are connected by linear
+interpolation and its transpose.  The coarse operators are
+rediscretized with the coarse (possibly different) row and
+column spacings.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+PRE_SMOOTH = 2
+POST_SMOOTH = 2
+COARSEST_SWEEPS = 50
+
+
+def _interpolation(m, mc):
+    # Linear interpolation from mc interior points to m interior
+    # points on the same interval, as an (m x mc) sparse matrix.
+    # Coarse points sit at k*(m+1)/(mc+1), k = 0..mc+1; the end
+    # points are boundary values, which are zero for the error
+    # equation and can be dropped.
+    x = np.arange(1, m + 1) * (mc + 1.0) / (m + 1.0)
+    k = np.floor(x).astype(int)
+    w = x - k
+    rows = np.concatenate([np.arange(m), np.arange(m)])
+    cols = np.concatenate([k - 1, k])
+    vals = np.concatenate([1.0 - w, w])
+    keep = (cols >= 0) & (cols < mc) & (vals != 0)
+    return sparse.csr_matrix((vals[keep], (rows[keep], cols[keep])),
+                             shape=(m, mc))
+
+
+class _Level(object):
+
+    def __init__(self, m, n, hr, hc):
+        self.shape = (m, n)
+        self.cr = 1.0 / (hr * hr)
+        self.cc = 1.0 / (hc * hc)
+        self.diag = 2.0 * (self.cr + self.cc)
+        (i, j) = np.indices((m, n))
+        self.red = (i + j) % 2 == 0
+        self.black = ~self.red
+        self.coarse = None
+        mc = (m - 1) // 2 if m >= 3 else m
+        nc = (n - 1) // 2 if n >= 3 else n
+        if (mc, nc) != (m, n):
+            self.pr = _interpolation(m, mc) if mc != m else sparse.identity(m, format='csr')
+            self.pc = _interpolation(n, nc) if nc != n else sparse.identity(n, format='csr')
+            self.scale = (mc + 1.0) / (m + 1.0) * (nc + 1.0) / (n + 1.0)
+            self.coarse = _Level(mc, nc,
+                                 hr * (m + 1.0) / (mc + 1.0),
+                                 hc * (n + 1.0) / (nc + 1.0))
+
+    def neighbours(self, u):
+        # (N + S)/hr^2 + (E + W)/hc^2 for every interior point,
+        # where u is padded with its boundary values.
+        return (self.cr * (u[:-2, 1:-1] + u[2:, 1:-1])
+                + self.cc * (u[1:-1, :-2] + u[1:-1, 2:]))
+
+    def residual(self, u, f):
+        return f - (self.diag * u[1:-1, 1:-1] - self.neighbours(u))
+
+    def smooth(self, u, f, sweeps):
+        # Red-black Gauss-Seidel.
+        inner = u[1:-1, 1:-1]
+        for _i in range(sweeps):
+            for mask in (self.red, self.black):
+                new = (self.neighbours(u) + f) / self.diag
+                inner[mask] = new[mask]
+
+    def restrict(self, r):
+        return self.scale * (self.pr.T.dot(self.pc.T.dot(r.T).T))
+
+    def prolong(self, e):
+        return self.pr.dot(self.pc.dot(e.T).T)
+
+
+def _vcycle(level, u, f):
+    if level.coarse is None:
+        level.smooth(u, f, COARSEST_SWEEPS)
+        return
+    level.smooth(u, f, PRE_SMOOTH)
+    rc = level.restrict(level.residual(u, f))
+    ec = np.zeros((rc.shape[0] + 2, rc.shape[1] + 2))
+    _vcycle(level.coarse, ec, rc)
+    u[1:-1, 1:-1] += level.prolong(ec[1:-1, 1:-1])
+    level.smooth(u, f, POST_SMOOTH)
+
+
+def solve(field, tol=1e-5, max_cycles=50):
+    """
+    Return (equilibrium, residuals): the steady state of newField
+    for the edges of `field`, starting from its interior, and the
+    max-norm residual max|average(i,j) - f(i,j)| after each V-cycle.
+    """
+    u = np.array(field, dtype=np.float64)
+    (rows, cols) = u.shape
+    residuals = []
+    if rows < 3 or cols < 3:
+        return (u.astype(np.float32), residuals)
+    level = _Level(rows - 2, cols - 2, 1.0, 1.0)
+    f = np.zeros((rows - 2, cols - 2))
+    for _i in range(max_cycles):
+        _vcycle(level, u, f)
+        residuals.append(float(np.abs(level.residual(u, f)).max()) / 4.0)
+        if residuals[-1] < tol:
+            break
+    return (u.astype(np.float32), residuals)
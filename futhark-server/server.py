@@ -25,7 +25,10 @@ command
    $ futhark pyopencl --library heat.fut
 
 It will create a file `heat.py` which is imported
-here.
+by the Futhark backend in `backends.py`.  On hosts
+without OpenCL the numpy backend is used instead.
+Set HEAT_BACKEND=futhark or HEAT_BACKEND=numpy to
+choose one explicitly.
 
 PLANS: the next step is to write an Elm client
 that will talk to server.py and produce a visual
@@ -59,14 +62,32 @@ Send a POST request::
 ## http://introtopython.org/classes.html
 
 
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from socketserver import ThreadingMixIn
 
+import io
 import os
+import itertools
+import threading
 import json
+import struct
 import numpy as np
-from scipy import misc
 import png
-import heat # import heat.py
+import backends
+import spectral
+import multigrid
+from sessions import SessionManager
+from coalesce import Coalescer
+from framecache import FrameCache, FrameGone, FIELD
+import frames
+import encoding
+import ingest
 import time
 
 png.from_array([[255, 0, 0, 255],
@@ -83,49 +104,202 @@ f.close()
 # Run `futhark pyopencl --library heat.fut`
 # to produce heat.py
 
-heatKernel = heat.heat()
-
-
-# The class which manages state
+# HEAT_THREADS and HEAT_TIME_BLOCK tune the numpy backend:
+# number of threads (default: one per core) and number of
+# iterations fused per pass over memory (default: 1).
+# HEAT_PROCESSES is the number of worker processes of the
+# shared-memory backend (HEAT_BACKEND=shm).  HEAT_CLUSTER,
+# HEAT_CLUSTER_GRID and HEAT_CLUSTER_HALO configure the
+# multi-node backend (HEAT_BACKEND=cluster, see cluster.py).
+backend = backends.make_backend(os.environ.get('HEAT_BACKEND'),
+                                threads=int(os.environ.get('HEAT_THREADS', 0)),
+                                time_block=int(os.environ.get('HEAT_TIME_BLOCK', 1)),
+                                processes=int(os.environ.get('HEAT_PROCESSES', 0)),
+                                cluster=os.environ.get('HEAT_CLUSTER'),
+                                grid=os.environ.get('HEAT_CLUSTER_GRID'),
+                                halo=int(os.environ.get('HEAT_CLUSTER_HALO', 4)))
+print("Using " + backend.name + " backend")
+
+# Size of the field a new session starts with.
+default_n = 20
+
+# The cluster backend cannot split fields that are too
+# small for its grid; say so now rather than on every new
+# session.
+if hasattr(backend, 'check_shape'):
+    backend.check_shape((default_n, default_n))
+
+# Steps of at least this many iterations are computed with
+# spectral.fast_forward instead of iterating the kernel,
+# unless the backend's fields are not host_sized.  Set to 0
+# to always iterate.
+spectral_threshold = int(os.environ.get('HEAT_SPECTRAL_THRESHOLD', 500))
+
+
+# Recent frames of all sessions, in host memory, see
+# framecache.py.  HEAT_FRAME_CACHE_MB bounds its size.
+frame_cache = FrameCache(int(os.environ.get('HEAT_FRAME_CACHE_MB', 256)) << 20)
+session_ids = itertools.count()
+
+
+# The class which manages state.  `state` lives on the
+# backend's device; `field()` reads it back to the host
+# only when asked, at most once per step.
 class Data():
   def __init__(self, n):
         self.n = n
         data = np.random.rand(n,n)
         array = np.array(data, dtype=np.float32)
-        self.state = array
+        self.state = backend.upload(array)
+        self.host = None
+        self.host_count = -1
         self.png = []
         self.count = 0
         self.iterations = 1
         self.beta = 0.1
+        self.residuals = []
+        # Identifies the session's frames in the frame cache.
+        self.id = next(session_ids)
+        self.pyramid = []
+        self.pyramid_count = -1
+        self.check_every = 100
+        self.max_iterations = 1000000
 
   ## def save(self):
 
+  # futhark backend:
   # n = 1000, t = 4 ms
   # n = 2000, t = 14 ms (x 3.5)
   # n = 4000, t = 50 ms (x 3.57)
+  #
+  # numpy backend, one thread, tiled:
+  # n = 1000, t = 5 ms
+  # n = 2000, t = 19 ms (x 3.8)
+  # n = 4000, t = 48 ms (x 2.5)
 
   def step(self):
-        print "STEP, iterations = "  + str(self.iterations)
+        print("STEP, iterations = "  + str(self.iterations))
         start = time.time()
-        (self.state, self.png) = heatKernel.main(self.iterations,self.beta, self.state)
+        if (backend.host_sized and spectral_threshold > 0
+                and self.iterations >= spectral_threshold):
+            field = spectral.fast_forward(self.field(), self.iterations, self.beta)
+            self.state = backend.upload(field)
+        else:
+            self.state = backend.step(self.state, self.iterations, self.beta)
         end = time.time()
-        print 1000*(end - start)
-        # print self.png.get().astype(np.uint8)
-        # print type(self.png.get().astype(np.uint8))
-        outfile = "heat_image_" + str(self.count) + ".png"
-        misc.imsave(outfile, self.png.get().astype(np.uint8))
+        print(1000*(end - start))
+        self.count = self.count + 1
+
+  # Iterate until no cell changes by more than `tol` in one
+  # iteration, checking every `check_every` iterations.
+  # Returns (iterations, last change).
+  def step_until(self, tol):
+        start = time.time()
+        done = 0
+        delta = float('inf')
+        while done < self.max_iterations:
+            k = min(self.check_every, self.max_iterations - done)
+            if k > 1:
+                self.state = backend.step(self.state, k - 1, self.beta)
+            (self.state, delta) = backend.step_delta(self.state, self.beta)
+            done = done + k
+            if delta < tol:
+                break
+        end = time.time()
+        print("STEP_UNTIL, iterations = " + str(done) + ", " + str(1000*(end - start)))
+        self.count = self.count + 1
+        return (done, delta)
+
+  # Replace the state by the equilibrium for the current
+  # edges.  The residual after each V-cycle is kept in
+  # `residuals`.  Fields that are not host_sized are
+  # iterated until no cell changes by more than `tol`
+  # instead, and `residuals` holds that last change.
+  def solve(self, tol):
+        if not backend.host_sized:
+            (_done, delta) = self.step_until(tol)
+            self.residuals = [delta]
+            return
+        start = time.time()
+        (field, self.residuals) = multigrid.solve(self.field(), tol)
+        self.state = backend.upload(field)
+        end = time.time()
+        print("SOLVE, cycles = " + str(len(self.residuals)) + ", " + str(1000*(end - start)))
         self.count = self.count + 1
+        self.keep_host(field)
+
+  # Render the current state and save it as a PNG file.
+  # Only done when a client asks for an image.
+  def save_png(self):
+        self.png = backend.render(self.state)
+        outfile = "heat_image_" + str(self.count) + ".png"
+        (rows, cols, _) = self.png.shape
+        png.from_array(self.png.reshape(rows, 3*cols), 'RGB').save(outfile)
+        return outfile
+
+  # The same image as save_png, encoded in memory.
+  def png_bytes(self):
+        self.png = backend.render(self.state)
+        (rows, cols, _) = self.png.shape
+        out = io.BytesIO()
+        png.Writer(cols, rows, greyscale=False).write(out, self.png.reshape(rows, 3*cols))
+        return out.getvalue()
+
+  def field(self):
+        if self.host_count != self.count:
+            self.keep_host(backend.download(self.state))
+        return self.host
+
+  # The host copy of the current frame, which also goes
+  # into the frame cache for delta bases and late reads.
+  def keep_host(self, array):
+        self.host = array
+        self.host_count = self.count
+        frame_cache.put((self.id, self.count, FIELD), array)
+
+  # Level k of the block-averaged pyramid, level 0 being
+  # the field itself, or the (r0, r1, c0, c1) `window` of
+  # it.  The pyramid is rebuilt by the backend, on the
+  # device, the first time a level is asked for after the
+  # field changes.
+  def level(self, k, window=None):
+        if k > 0 and self.pyramid_count != self.count:
+            self.pyramid = backend.mipmap(self.state, frames.lod_levels(self.state.shape))
+            self.pyramid_count = self.count
+        k = min(k, len(self.pyramid))
+        if k > 0:
+            if window is not None:
+                window = frames.clip_window(window, self.pyramid[k - 1].shape)
+            return backend.lod(self.pyramid, k, window)
+        if window is None:
+            return self.field()
+        (r0, r1, c0, c1) = frames.clip_window(window, self.state.shape)
+        if self.host_count == self.count:
+            return self.host[r0:r1, c0:c1]
+        return backend.crop(self.state, (r0, r1, c0, c1))
 
   def reset(self):
       data = np.random.rand(self.n,self.n)
       for i in range(self.n//2, 4*self.n//5):
           for j in range(self.n//2, 4*self.n//5):
               data[i,j] = 0
-      for i in range(self.n//5, 2*self.n/5):
+      for i in range(self.n//5, 2*self.n//5):
           for j in range(self.n//5, 2*self.n//5):
               data[i,j] = 1.0
       array = np.array(data, dtype=np.float32)
-      self.state = array
+      self.state = backend.upload(array)
+      # A new frame: step counts double as frame ids.
+      self.count = self.count + 1
+      self.keep_host(array)
+
+  # Replace the field by an uploaded one (see ingest.py).
+  # The array may be a memmap; it is not kept.
+  def load(self, array):
+      self.state = backend.upload(array)
+      self.n = array.shape[0]
+      self.count = self.count + 1
+      self.host = None
+      self.host_count = -1
 
   def set_beta(self, beta):
       self.beta = beta
@@ -138,50 +312,91 @@ class Data():
     print ("In set_iterations (X), iterations = " + str(self.iterations))
 
 
-myData = Data(20)
+  # Frames in the frame cache have their own budget.
+  def host_bytes(self):
+      size = 0 if self.host is None else self.host.nbytes
+      return size + getattr(self.png, 'nbytes', 0)
+
+  def device_bytes(self):
+      return self.state.nbytes + sum(level.nbytes for level in self.pyramid)
+
+
+# Every client gets its own Data, selected by a
+# `?session=TOKEN` suffix on the command; clients that
+# send none share the session "".  The least recently
+# used sessions are dropped when the sessions together
+# use more than HEAT_HOST_MEMORY_MB of host memory or
+# HEAT_DEVICE_MEMORY_MB of backend memory.
+sessions = SessionManager(lambda: Data(default_n),
+                          int(os.environ.get('HEAT_HOST_MEMORY_MB', 4096)) << 20,
+                          int(os.environ.get('HEAT_DEVICE_MEMORY_MB', 2048)) << 20)
 
 ### END: MANIPULATE DATA USING FUTHARK ####
 
 
 def parse(str):
-    parts = str.lstrip("/").split("=")
+    (path, _sep, query) = str.partition("?")
+    session = ""
+    for param in query.split("&"):
+        (key, _sep, value) = param.partition("=")
+        if key == "session":
+            session = value
+    parts = path.lstrip("/").split("=")
     if len(parts) == 2:
-        return { 'cmd': parts[0], 'arg': parts[1], 'arity': 1}
+        return { 'cmd': parts[0], 'arg': parts[1], 'arity': 1, 'session': session}
     else:
-        return { 'cmd': parts[0], 'arg': "", 'arity': 0}
-
-def step(n_iterations):
-    myData.iterations = int(n_iterations)
-    myData.step()
-    nn = myData.n * myData.n
-    return myData.state.reshape(1,nn).get()[0].tobytes()
-
-def reset():
-    myData.reset()
-    nn = myData.n * myData.n
-    return myData.state.reshape(1,nn).tobytes()
-
-def data():
-    nn = myData.n * myData.n
-    if myData.count == 0:
-        dd = myData.state.reshape(1,nn)[0]
-        print "(0)"
-    else:
-        dd = myData.state.reshape(1,nn).get()[0]
-        print "(>0)"
-    return dd.tobytes()
+        return { 'cmd': parts[0], 'arg': "", 'arity': 0, 'session': session}
+
+# `step` and `data` take optional format options, see frames.py.
+def step(d, args):
+    args = args.split(",")
+    d.iterations = int(args[0])
+    d.step()
+    return frames.encode(backend, d, args[1:], frame_cache)
+
+def reset(d):
+    d.reset()
+    return d.field().tobytes()
+
+def data(d, options=""):
+    return frames.encode(backend, d, options.split(","), frame_cache)
+
+def step_until(d, tol):
+    (iterations, delta) = d.step_until(float(tol))
+    return json.dumps({'iterations': iterations, 'delta': delta})
 
-def beta(beta):
-    myData.set_beta(float(beta))
+def solve(d, tol="1e-5"):
+    d.solve(float(tol))
+    return d.field().tobytes()
+
+def residuals(d):
+    return json.dumps(d.residuals)
+
+def image(d):
+    outfile = d.save_png()
+    with open(outfile, 'rb') as f:
+        return f.read()
+
+def stats(d):
+    (lo, hi, mean) = backend.stats(d.state)
+    return json.dumps({'min': lo, 'max': hi, 'mean': mean, 'count': d.count})
+
+def status(d):
+    return json.dumps({'n': d.n, 'count': d.count,
+                       'iterations': d.iterations, 'beta': d.beta,
+                       'backend': backend.name})
+
+def beta(d, beta):
+    d.set_beta(float(beta))
     return "beta = " + beta
 
-def do_set_n(n):
-    myData.set_n(int(n))
+def do_set_n(d, n):
+    d.set_n(int(n))
     return "n = " + n
 
-def do_set_iterations(n):
+def do_set_iterations(d, n):
     print ("In do_set_iterations, n = " + n)
-    myData.set_iterations(int(n))
+    d.set_iterations(int(n))
     return "iterations = " + n
 
 def defaultResponse():
@@ -190,51 +405,233 @@ def defaultResponse():
 op = { 'step':  step,
        'data':  data,
        'reset': reset,
+       'step_until': step_until,
+       'solve': solve,
+       'residuals': residuals,
+       'png': image,
+       'stats': stats,
+       'status': status,
        'beta': beta,
        'n': do_set_n,
        'iterations': do_set_iterations}
 
 
+def dispatch(d, c):
+    """Run the parsed command `c` against session `d`."""
+    if c['arity'] == 0:
+        print("cmd = " + c['cmd'])
+        result = op[c['cmd']](d)
+    else:
+        print("cmd = " + c['cmd'] + ", arg = " + c['arg'])
+        result = op[c['cmd']](d, c['arg'])
+    if not isinstance(result, bytes):
+        result = result.encode('utf-8')
+    return result
+
+
 def response(command_string):
     c = parse(command_string)
     if c['cmd'] in op:
-       if c['arity'] == 0:
-           print "cmd = " + c['cmd']
-           return op[c['cmd']]()
-       else:
-           print "cmd = " + c['cmd'] + ", arg = " + c['arg']
-           return op[c['cmd']](c['arg'])
+       d = sessions.get(c['session'])
+       result = dispatch(d, c)
+       sessions.enforce(c['session'])
     else:
-       return defaultResponse()
+       result = defaultResponse().encode('utf-8')
+    return result
+
+
+# POST /upload=<options>?session=TOKEN replaces the
+# session's field by the one in the body, see ingest.py.
+def upload(command_string, array):
+    c = parse(command_string)
+    d = sessions.get(c['session'])
+    d.load(array)
+    sessions.enforce(c['session'])
+    (rows, cols) = array.shape
+    return json.dumps({'rows': rows, 'cols': cols, 'count': d.count})
+
+
+# POST /batch?session=TOKEN runs a JSON list of commands,
+# e.g. ["beta=0.2", "iterations=10", "step=10,u8"], one
+# after the other against the session, with nothing else
+# in between.  The reply frames the results in order:
+# u32 count, then a u32 length and the bytes of each
+# result, little-endian.  Session suffixes on the listed
+# commands are ignored.  A command that fails (a bad
+# argument, a frame no longer cached) gets its error
+# message as its result and the rest still run; a body
+# that is not a JSON list of strings is a ValueError.
+def batch(command_string, body):
+    c = parse(command_string)
+    commands = json.loads(body.decode('utf-8'))
+    if not (isinstance(commands, list)
+            and all(isinstance(command, type(u'')) for command in commands)):
+        raise ValueError("the body must be a JSON list of command strings")
+    d = sessions.get(c['session'])
+    results = []
+    for command in commands:
+        cc = parse(command)
+        if cc['cmd'] in op:
+            try:
+                results.append(dispatch(d, cc))
+            except (ValueError, TypeError, FrameGone) as e:
+                results.append(str(e).encode('utf-8'))
+        else:
+            results.append(defaultResponse().encode('utf-8'))
+    sessions.enforce(c['session'])
+    out = [struct.pack('<I', len(results))]
+    for result in results:
+        out.append(struct.pack('<I', len(result)))
+        out.append(result)
+    return b''.join(out)
+
+
+# Replies that are compressed already.
+PRECOMPRESSED = set(['png'])
+
+# Content types of replies; other commands reply with text.
+content_types = { 'step': 'application/octet-stream',
+                  'data': 'application/octet-stream',
+                  'reset': 'application/octet-stream',
+                  'solve': 'application/octet-stream',
+                  'png': 'image/png',
+                  'step_until': 'application/json',
+                  'residuals': 'application/json',
+                  'stats': 'application/json',
+                  'status': 'application/json'}
+
+
+def content_type(command_string):
+    return content_types.get(parse(command_string)['cmd'], 'text/html')
+
+
+def content_encoding(command_string, accept, body):
+    """The Content-Encoding for `body`, or None."""
+    if parse(command_string)['cmd'] in PRECOMPRESSED:
+        return None
+    return encoding.negotiate(accept, len(body))
+
+
+# Connections are served on their own threads, but
+# commands run one at a time.
+compute_lock = threading.Lock()
+
+# Identical `step` requests that arrive within
+# HEAT_COALESCE_MS of each other (or while the first is
+# still waiting or running) are run once, see coalesce.py.
+COALESCED = set(['step'])
+coalescer = Coalescer(float(os.environ.get('HEAT_COALESCE_MS', 2)) / 1000)
+
+
+def locked_response(command_string):
+    with compute_lock:
+        return response(command_string)
 
 
 class S(BaseHTTPRequestHandler):
 
-    def _set_headers(self):
+    # Connections stay open between requests; requests
+    # pipelined on one connection are answered in order.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _set_headers(self, ctype='text/html', length=0, content_encoding=None):
         self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-type', ctype)
         self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Vary', 'Accept-Encoding')
+        if content_encoding:
+            self.send_header('Content-Encoding', content_encoding)
+            # The compressed length isn't known up front.
+            if self.request_version == 'HTTP/1.0':
+                self.close_connection = True
+            else:
+                self.send_header('Transfer-Encoding', 'chunked')
+        elif length is not None:
+            self.send_header('Content-Length', str(length))
         self.end_headers()
 
+    def _send(self, body, ctype, coding=None):
+        self._set_headers(ctype, len(body), coding)
+        if not coding:
+            self.wfile.write(body)
+        elif self.close_connection:
+            encoding.stream(body, coding, self.wfile.write)
+        else:
+            write = lambda piece: self.wfile.write(encoding.chunk(piece))
+            encoding.stream(body, coding, write)
+            self.wfile.write(encoding.LAST_CHUNK)
+
     def do_GET(self):
         start = time.time()
-        self._set_headers()
-        self.wfile.write(response(self.path))
+        try:
+            if parse(self.path)['cmd'] in COALESCED:
+                body = coalescer.run(self.path, lambda: locked_response(self.path))
+            else:
+                body = locked_response(self.path)
+        except FrameGone as e:
+            self.send_error(404, str(e))
+            return
+        except (ValueError, TypeError) as e:
+            # A malformed argument, e.g. step=abc or data=roi:1:2.
+            self.send_error(400, str(e))
+            return
+        coding = content_encoding(self.path, self.headers.get('Accept-Encoding'), body)
+        self._send(body, content_type(self.path), coding)
         end = time.time()
-        print 1000*(end - start)
+        print(1000*(end - start))
 
     def do_HEAD(self):
-        self._set_headers()
+        # The length of the GET reply isn't known without
+        # running the command, so none is sent.
+        self._set_headers(content_type(self.path), None)
 
     def do_POST(self):
-        # Doesn't do anything with posted data
-        self._set_headers()
-        self.wfile.write("<html><body><h1>POST!</h1></body></html>")
+        start = time.time()
+        length = int(self.headers.get('Content-Length') or 0)
+        if parse(self.path)['cmd'] == 'upload':
+            try:
+                array = ingest.read_field(self.rfile.read, length,
+                                          *ingest.parse_args(parse(self.path)['arg']))
+            except ValueError as e:
+                # The rest of the body is unread.
+                self.close_connection = True
+                self.send_error(400, str(e))
+                return
+            try:
+                with compute_lock:
+                    reply = upload(self.path, array)
+            except ValueError as e:
+                # The backend can't hold it, e.g. too small for
+                # the cluster grid.
+                self.send_error(400, str(e))
+                return
+            self._send(reply.encode('utf-8'), 'application/json')
+            return
+        body = self.rfile.read(length)
+        if parse(self.path)['cmd'] == 'batch':
+            try:
+                with compute_lock:
+                    reply = batch(self.path, body)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            coding = encoding.negotiate(self.headers.get('Accept-Encoding'), len(reply))
+            self._send(reply, 'application/octet-stream', coding)
+        else:
+            self._send(b"<html><body><h1>POST!</h1></body></html>", 'text/html')
+        end = time.time()
+        print(1000*(end - start))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
 
-def run(server_class=HTTPServer, handler_class=S, port=8001):
+def run(server_class=ThreadingHTTPServer, handler_class=S, port=8001):
     server_address = ('', port)
     httpd = server_class(server_address, handler_class)
-    print 'Starting httpd on port ' + str(port)
+    print('Starting httpd on port ' + str(port))
     httpd.serve_forever()
 
 if __name__ == "__main__":
@@ -0,0 +1,70 @@
+"""
+Per-client simulation sessions.
+
+Each session token gets its own `Data` (state, beta,
+iterations, ...).  Sessions are kept in least-recently-used
+order; whenever the sessions together hold more host or
+device memory than allowed, the least recently used ones
+are dropped, which frees their buffers.  The session being
+served is never evicted, even if it alone is over budget.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class SessionManager(object):
+
+    def __init__(self, factory, max_host_bytes, max_device_bytes):
+        self.factory = factory
+        self.max_host_bytes = max_host_bytes
+        self.max_device_bytes = max_device_bytes
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        """The session for `token`, created if need be."""
+        with self.lock:
+            session = self.sessions.pop(token, None)
+            if session is None:
+                print("New session " + repr(token))
+                session = self.factory()
+            self.sessions[token] = session
+            self._evict(token)
+            return session
+
+    def peek(self, token, fn):
+        """
+        fn(session) for an existing session, or None if there
+        is none.  Never creates or evicts a session, and holds
+        the lock throughout, so that an eviction elsewhere
+        cannot leave the last reference with the caller.
+        """
+        with self.lock:
+            session = self.sessions.pop(token, None)
+            if session is None:
+                return None
+            self.sessions[token] = session
+            try:
+                return fn(session)
+            finally:
+                del session
+
+    def enforce(self, keep):
+        """Evict sessions until within budget, sparing `keep`."""
+        with self.lock:
+            self._evict(keep)
+
+    def usage(self):
+        host = sum(s.host_bytes() for s in self.sessions.values())
+        device = sum(s.device_bytes() for s in self.sessions.values())
+        return (host, device)
+
+    def _evict(self, keep):
+        while len(self.sessions) > 1:
+            (host, device) = self.usage()
+            if host <= self.max_host_bytes and device <= self.max_device_bytes:
+                break
+            oldest = next(t for t in self.sessions if t != keep)
+            print("Evicting session " + repr(oldest))
+            del self.sessions[oldest]
@@ -0,0 +1,480 @@
+# Checks for the Python side of the server.  Run using
+#
+#   python3 test3.py
+#
+# Every backend is compared against `new_field` below, a
+# direct transcription of newField in heat.fut.  Prints one
+# line per check and exits with status 1 if any failed.
+#
+import asyncio
+import coalesce
+import io
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
+import numpy as np
+
+import backends
+import cluster
+import encoding
+import frames
+import framecache
+import ingest
+import multigrid
+import sessions
+import spectral
+import websocket
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+failures = []
+
+
+def check(name, ok):
+    print(("ok      " if ok else "FAILED  ") + name)
+    if not ok:
+        failures.append(name)
+
+
+def close(a, b, tol):
+    return a.shape == b.shape and (a.size == 0 or float(np.abs(a - b).max()) <= tol)
+
+
+#### REFERENCE ####
+
+def new_field(beta, field):
+    out = field.copy()
+    s = field[:-2, 1:-1] + field[2:, 1:-1] + field[1:-1, :-2] + field[1:-1, 2:]
+    out[1:-1, 1:-1] = (1 - beta) * field[1:-1, 1:-1] + beta * (s / 4)
+    return out
+
+
+def reference(field, iterations, beta):
+    field = np.array(field, dtype=np.float64)
+    for _i in range(iterations):
+        field = new_field(beta, field)
+    return field
+
+
+def reference_delta(field, beta):
+    new = reference(field, 1, beta)
+    return (new, float(np.abs(new - field).max()))
+
+
+rng = np.random.RandomState(0)
+field = rng.rand(37, 53).astype(np.float32)
+
+
+#### BACKENDS ####
+
+def check_backend(name, backend, a, iterations=13, beta=0.3):
+    ref = reference(a, iterations, beta)
+    state = backend.step(backend.upload(a), iterations, beta)
+    check(name + " step", close(backend.download(state), ref, 1e-5))
+    (state, delta) = backend.step_delta(state, beta)
+    (ref, ref_delta) = reference_delta(ref, beta)
+    check(name + " step_delta", close(backend.download(state), ref, 1e-5)
+          and abs(delta - ref_delta) < 1e-5)
+    for window in ((3, 20, 5, 41), (0, 2, 0, 3), (30, 37, 50, 53)):
+        window = frames.clip_window(window, a.shape)
+        check(name + " crop " + str(window),
+              close(backend.crop(state, window),
+                    backends.crop_array(backend.download(state), window), 0))
+
+
+check_backend("numpy", backends.NumpyBackend(threads=1), field)
+check_backend("numpy, 4 threads", backends.NumpyBackend(threads=4), field)
+# Iteration counts that are not multiples of the time block.
+for k in (2, 3, 5):
+    check_backend("numpy, time_block=" + str(k),
+                  backends.NumpyBackend(threads=3, time_block=k), field)
+check_backend("numpy, 3x4 field", backends.NumpyBackend(threads=2, time_block=4),
+              field[:3, :4].copy(), iterations=7)
+
+betas = [0.1, 0.25, 0.5]
+ensemble = np.stack([field, field[::-1], field[:, ::-1]])
+numpy_backend = backends.NumpyBackend(threads=2, time_block=2)
+state = numpy_backend.step_ensemble(numpy_backend.upload(ensemble), 9, betas)
+check("numpy ensemble", all(close(numpy_backend.download(state)[m],
+                                  reference(ensemble[m], 9, betas[m]), 1e-5)
+                            for m in range(3)))
+if sys.platform.startswith('linux'):
+    check_backend("shm", backends.SharedMemoryBackend(processes=4), field)
+    check_backend("shm, 3x4 field", backends.SharedMemoryBackend(processes=3),
+                  field[:3, :4].copy(), iterations=7)
+
+# What cluster workers do with their halos.
+window = (2, 7, 3, 10)
+strip = rng.rand(5, 7).astype(np.float32)
+pasted = field.copy()
+pasted[2:7, 3:10] = strip
+state = numpy_backend.paste(numpy_backend.upload(field), window, strip)
+check("numpy paste", close(numpy_backend.crop(state, window), strip, 0))
+state = numpy_backend.step(state, 3, 0.3)
+check("numpy step after paste", close(numpy_backend.download(state),
+                                      reference(pasted, 3, 0.3), 1e-5))
+check("numpy render", close(backends.NumpyBackend().render(backends.Field(field))[..., 0],
+                            (255 * field).astype(np.uint8), 0))
+
+
+#### SPECTRAL AND MULTIGRID ####
+
+check("spectral fast_forward",
+      close(spectral.fast_forward(field, 200, 0.3), reference(field, 200, 0.3), 1e-4))
+check("spectral fast_forward, 0 iterations",
+      close(spectral.fast_forward(field, 0, 0.3), field, 1e-6))
+
+small = field[:17, :23].copy()
+(steady, residuals) = multigrid.solve(small, tol=1e-6)
+check("multigrid residuals", residuals[-1] < 1e-6)
+check("multigrid = spectral steady state",
+      close(steady, spectral.fast_forward(small, 100000, 0.5), 1e-4))
+check("multigrid is a fixed point of newField",
+      close(reference(steady, 1, 0.5), steady, 1e-5))
+
+
+#### CLUSTER ####
+
+def free_port():
+    s = socket.socket()
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def rejected(f, *args):
+    try:
+        f(*args)
+    except ValueError:
+        return True
+    return False
+
+
+ports = [free_port() for _i in range(4)]
+workers = [subprocess.Popen([sys.executable, '-u', os.path.join(here, 'cluster.py'),
+                             'worker', str(p), 'numpy'],
+                            stdout=subprocess.PIPE)
+           for p in ports]
+try:
+    for w in workers:
+        w.stdout.readline()    # "Cluster worker on port ..."
+    for (grid, halo) in (('2x2', 3), ('1x4', 4), ('4x1', 2)):
+        backend = cluster.ClusterBackend(','.join('localhost:' + str(p) for p in ports),
+                                         grid, halo)
+        check_backend("cluster " + grid + ", halo " + str(halo), backend, field)
+        check("cluster " + grid + " rejects blocks thinner than the halo",
+              rejected(backend.upload, field[:7, :5].copy()))
+        for sock in backend.workers:
+            cluster.send_msg(sock, {'op': 'close'})
+finally:
+    for w in workers:
+        w.kill()
+        w.wait()
+
+
+#### SESSIONS ####
+
+class FakeSession(object):
+
+    def __init__(self, size):
+        self.size = size
+
+    def host_bytes(self):
+        return self.size
+
+    def device_bytes(self):
+        return 0
+
+
+made = []
+
+
+def make_session():
+    made.append(FakeSession(100))
+    return made[-1]
+
+
+manager = sessions.SessionManager(make_session, 250, 1000)
+session_a = manager.get('a')
+manager.get('b')
+check("one session per token", manager.get('a') is session_a and len(made) == 2)
+manager.get('c')
+check("least recently used session evicted", list(manager.sessions) == ['a', 'c'])
+session_a.size = 1000
+manager.enforce('a')
+check("session being served not evicted", list(manager.sessions) == ['a'])
+check("peek at an existing session", manager.peek('a', lambda s: s.size) == 1000)
+check("peek creates no session", manager.peek('z', lambda s: s.size) is None
+      and list(manager.sessions) == ['a'] and len(made) == 3)
+
+
+#### WEBSOCKET ####
+
+# The example of RFC 6455, section 1.3.
+reply = websocket.handshake({'sec-websocket-key': 'dGhlIHNhbXBsZSBub25jZQ=='})
+check("websocket handshake", b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=' in reply)
+
+
+def client_frame(opcode, payload, mask=b'\x01\x02\x03\x04'):
+    n = len(payload)
+    if n < 126:
+        head = struct.pack('!BB', 0x80 | opcode, 0x80 | n)
+    elif n < 1 << 16:
+        head = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, n)
+    else:
+        head = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, n)
+    return head + mask + bytes(b ^ mask[i % 4] for (i, b) in enumerate(payload))
+
+
+def read_frame(data):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await websocket.read_frame(reader)
+    return asyncio.new_event_loop().run_until_complete(read())
+
+
+for n in (5, 300, 70000):
+    payload = bytes(bytearray(i % 251 for i in range(n)))
+    out = websocket.frame(websocket.BINARY, payload)
+    check("websocket frame of " + str(n) + " bytes",
+          out.endswith(payload) and len(out) - n == (2 if n < 126 else 4 if n < 65536 else 10)
+          and out[0] == 0x80 | websocket.BINARY)
+    check("websocket client frame of " + str(n) + " bytes",
+          read_frame(client_frame(websocket.TEXT, payload)) == (websocket.TEXT, payload))
+
+
+#### ENCODINGS ####
+
+def decode_delta(body, base):
+    (mode, frame_id, base_id, rows, cols) = struct.unpack('<B3xiiII', body[:20])
+    planes = np.frombuffer(zlib.decompress(body[20:]), dtype=np.uint8)
+    values = planes.reshape(4, -1).T.copy().view(np.uint32).reshape(rows, cols)
+    if mode == frames.DELTA:
+        if base_id >= 0:
+            values = values ^ base.view(np.uint32)
+        return (mode, base_id, values.view(np.float32))
+    d = values.astype(np.int64)
+    d = (d >> 1) ^ -(d & 1)
+    if base_id >= 0:
+        d = d + np.rint(base.astype(np.float64) * frames.QUANTUM).astype(np.int64)
+    return (mode, base_id, (d / float(frames.QUANTUM)).astype(np.float32))
+
+
+base = field
+current = new_field(0.3, field).astype(np.float32)
+for (mode, name, tol) in ((frames.DELTA, "delta", 0), (frames.QDELTA, "qdelta", 2.0 ** -16)):
+    (m, base_id, out) = decode_delta(frames.encode_delta(mode, 8, current, 7, base), base)
+    check(name + " against a base", m == mode and base_id == 7 and close(out, current, tol))
+    (m, base_id, out) = decode_delta(frames.encode_delta(mode, 8, current, 7, None), None)
+    check(name + " key frame", m == mode and base_id == -1 and close(out, current, tol))
+large = current.copy()
+large[2, 3] = 1e6
+(m, base_id, out) = decode_delta(frames.encode_delta(frames.QDELTA, 8, large, 7, base), base)
+check("qdelta out of range -> delta key frame",
+      m == frames.DELTA and base_id == -1 and close(out, large, 0))
+(m, base_id, out) = decode_delta(frames.encode_delta(frames.QDELTA, 8, current, 7, large), large)
+check("qdelta with a base out of range -> qdelta key frame",
+      m == frames.QDELTA and base_id == -1 and close(out, current, 2.0 ** -16))
+
+for bits in (8, 16):
+    body = frames._quantized(bits, *numpy_backend.quantize(numpy_backend.upload(field), bits))
+    (lo, hi) = struct.unpack('<ff', body[:8])
+    q = np.frombuffer(body[8:], dtype='<u' + str(bits // 8)).reshape(field.shape)
+    step = (hi - lo) / ((1 << bits) - 1)
+    check("u" + str(bits), close(lo + q * step, field, step / 2 + 1e-6))
+    body = frames._quantized(bits, *backends.quantize_array(field[5:5, :], bits))
+    check("u" + str(bits) + " of an empty window", body == struct.pack('<ff', 0, 0))
+
+
+pyramid = backends.mipmap_array(field, frames.lod_levels(field.shape))
+check("lod levels", [p.shape for p in pyramid][-1] == (1, 1) and len(pyramid) == 6)
+check("lod 1", close(pyramid[0][:-1, :-1],
+                     field[:36, :52].reshape(18, 2, 26, 2).mean(axis=(1, 3)), 1e-6))
+check("lod 1, odd last row and column", close(pyramid[0][-1, -1:], field[-1:, -1], 1e-6))
+check("numpy mipmap", all(close(a, b, 0) for (a, b) in
+                          zip(numpy_backend.mipmap(numpy_backend.upload(field), 6), pyramid)))
+check("roi clipping", frames.clip_window((30, 100, -5, 10), field.shape) == (30, 37, 0, 10))
+check("roi parsing", frames.parse_window('1:2:3:4') == (1, 2, 3, 4)
+      and rejected(frames.parse_window, '1:2'))
+check("numpy lod with roi", close(numpy_backend.lod(pyramid, 2, (1, 4, 2, 9)),
+                                  pyramid[1][1:4, 2:9], 0))
+
+
+def decompress(data, name):
+    if name == 'xz':
+        import lzma
+        return lzma.decompress(data)
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS if name == 'gzip' else zlib.MAX_WBITS)
+
+
+body = field.tobytes() * 4
+for name in encoding.available():
+    pieces = list(encoding.chunks(body, name, size=1000))
+    check(name + " round trip", decompress(b''.join(pieces), name) == body)
+    pieces = []
+    encoding.stream(body, name, pieces.append, size=1000)
+    check(name + " streamed round trip", decompress(b''.join(pieces), name) == body)
+check("negotiate", encoding.negotiate('deflate;q=0.5, gzip', 5000) == 'gzip'
+      and encoding.negotiate('gzip', 10) is None
+      and encoding.negotiate('identity', 5000) is None
+      and encoding.negotiate('gzip;q=0, *', 5000) == 'deflate')
+
+
+def dechunk(data):
+    out = b''
+    while True:
+        (size, data) = data.split(b'\r\n', 1)
+        n = int(size, 16)
+        if n == 0:
+            return (out, data == b'\r\n')
+        out += data[:n]
+        data = data[n + 2:]
+
+
+pieces = [encoding.chunk(p) for p in (body[:1000], b'', body[1000:])]
+check("chunked transfer coding",
+      dechunk(b''.join(pieces) + encoding.LAST_CHUNK) == (body, True))
+
+
+#### INGEST ####
+
+def upload(body, arg=''):
+    return ingest.read_field(io.BytesIO(body).read, len(body), *ingest.parse_args(arg))
+
+
+for dtype in ('<f4', '<f8', '<i2', '>f4', 'u1'):
+    a = (field * 100).astype(dtype)
+    for order in ('C', 'F'):
+        f = io.BytesIO()
+        np.save(f, np.asarray(a, order=order))
+        out = upload(f.getvalue())
+        check("npy " + dtype + " " + order, close(out, a.astype(np.float32), 0))
+
+
+def futhark_value(a, name):
+    head = b'b\x02' + struct.pack('<b', a.ndim) + name.encode('latin-1')
+    return head + struct.pack('<' + 'Q' * a.ndim, *a.shape) + a.tobytes()
+
+
+check("futhark f32", close(upload(futhark_value(field, ' f32')), field, 0))
+a = (field * 1000).astype('<i4')
+check("futhark i32", close(upload(futhark_value(a, ' i32'), 'futhark'), a.astype(np.float32), 0))
+check("raw, square", close(upload(field[:20, :20].tobytes(), 'raw'), field[:20, :20], 0))
+check("raw, 37x53", close(upload(field.tobytes(), 'raw,37x53'), field, 0))
+check("empty upload rejected", rejected(upload, b''))
+check("2x5 upload rejected", rejected(upload, field[:2, :5].tobytes(), 'raw,2x5'))
+check("short upload rejected", rejected(upload, field.tobytes()[:-4], 'raw,37x53'))
+check("3D upload rejected", rejected(upload, futhark_value(ensemble, ' f32')))
+check("unknown format rejected", rejected(upload, field.tobytes(), 'tiff'))
+
+
+#### COALESCING ####
+
+calls = []
+
+
+def counted(key):
+    calls.append(key)
+    return key + str(len(calls))
+
+
+coalescer = coalesce.Coalescer(0.2)
+results = []
+threads = [threading.Thread(target=lambda key=key: results.append(
+               coalescer.run(key, lambda: counted(key))))
+           for key in ('a', 'a', 'a', 'b', 'a')]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+check("coalesced identical requests", sorted(calls) == ['a', 'b']
+      and len(set(r for r in results if r.startswith('a'))) == 1 and len(results) == 5)
+check("coalescer passes on errors", rejected(coalescer.run, 'c', lambda: int('x')))
+check("coalescer runs again afterwards", coalescer.run('a', lambda: counted('a')) == 'a3')
+
+
+#### FRAME CACHE ####
+
+cache = framecache.FrameCache(250)
+for key in ('a', 'b', 'c'):
+    cache.put(key, b'x' * 100)
+cache.put('c', b'x' * 100)
+cache.put('d', b'x' * 300)
+check("frame cache drops the oldest entries", list(cache.entries) == ['b', 'c']
+      and cache.nbytes == 200)
+
+
+class FakeFrames(object):
+    # The parts of server.Data that frames.encode uses.
+
+    def __init__(self, array):
+        self.id = 'f'
+        self.count = 5
+        self.state = numpy_backend.upload(array)
+        self.reads = 0
+
+    def field(self):
+        self.reads = self.reads + 1
+        array = numpy_backend.download(self.state)
+        cache.put((self.id, self.count, framecache.FIELD), array)
+        return array
+
+
+cache = framecache.FrameCache(1 << 20)
+d = FakeFrames(field)
+body = frames.encode(numpy_backend, d, ['delta:4'], cache)
+check("repeated frames come from the cache",
+      frames.encode(numpy_backend, d, ['delta:4'], cache) == body and d.reads == 1)
+d.count = 6
+d.state = numpy_backend.step(d.state, 1, 0.3)
+check("past frame", frames.encode(numpy_backend, d, ['frame:5'], cache) == field.tobytes())
+try:
+    frames.encode(numpy_backend, d, ['frame:2'], cache)
+    check("frame no longer cached", False)
+except framecache.FrameGone:
+    check("frame no longer cached", True)
+
+
+#### SERVER ####
+
+# Importing server.py writes its demo images to the
+# current directory, so do that somewhere else.
+os.chdir(tempfile.mkdtemp())
+os.environ['HEAT_BACKEND'] = 'numpy'
+import server
+
+
+def unframe(body):
+    (count,) = struct.unpack('<I', body[:4])
+    (results, at) = ([], 4)
+    for _i in range(count):
+        (n,) = struct.unpack('<I', body[at:at + 4])
+        results.append(body[at + 4:at + 4 + n])
+        at += 4 + n
+    return (results, at == len(body))
+
+
+(results, exact) = unframe(server.batch('/batch?session=b',
+                                        b'["beta=0.2", "step=3", "data", "nonsense"]'))
+check("batch reply framing", exact and len(results) == 4
+      and results[2] == server.response('/data?session=b')
+      and results[3] == b'unknown command')
+(results, exact) = unframe(server.batch('/batch?session=b',
+                                        b'["step=abc", "data=roi:1:2", "step=1"]'))
+check("failed batch commands", exact and len(results) == 3
+      and b'abc' in results[0] and len(results[2]) == 4 * server.default_n ** 2)
+check("batch body not a list of strings rejected",
+      all(rejected(server.batch, '/batch', body) for body in (b'["step=1"', b'"step=1"', b'[1]')))
+os.chdir(here)
+
+
+print(str(len(failures)) + " failed")
+sys.exit(1 if failures else 0)
@@ -0,0 +1,61 @@
+"""
+Minimal server side of the WebSocket protocol (RFC 6455)
+for asyncio streams: the opening handshake and unfragmented
+frames, which is all aioserver.py needs.
+"""
+
+import base64
+import hashlib
+import struct
+
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+
+def handshake(headers):
+    """The 101 response accepting the upgrade request with `headers`."""
+    key = headers['sec-websocket-key'].strip()
+    accept = base64.b64encode(hashlib.sha1((key + GUID).encode('latin-1')).digest())
+    return ("HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Accept: " + accept.decode('latin-1') + "\r\n"
+            "\r\n").encode('latin-1')
+
+
+def is_upgrade(headers):
+    return (headers.get('upgrade', '').lower() == 'websocket'
+            and 'sec-websocket-key' in headers)
+
+
+def frame(opcode, payload):
+    """An unmasked, final frame, as sent by a server."""
+    n = len(payload)
+    if n < 126:
+        head = struct.pack('!BB', 0x80 | opcode, n)
+    elif n < 1 << 16:
+        head = struct.pack('!BBH', 0x80 | opcode, 126, n)
+    else:
+        head = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+    return head + payload
+
+
+async def read_frame(reader):
+    """Return (opcode, payload) of the next frame from the client."""
+    (b0, b1) = struct.unpack('!BB', await reader.readexactly(2))
+    n = b1 & 0x7F
+    if n == 126:
+        (n,) = struct.unpack('!H', await reader.readexactly(2))
+    elif n == 127:
+        (n,) = struct.unpack('!Q', await reader.readexactly(8))
+    mask = await reader.readexactly(4) if b1 & 0x80 else None
+    payload = await reader.readexactly(n)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for (i, b) in enumerate(payload))
+    return (b0 & 0x0F, payload)